@@ -0,0 +1,530 @@
+"""
+服务器协议与热点路径的基准测试
+
+    python bench.py                 运行全部测试
+    python bench.py protocol        只运行指定的测试
+    python bench.py --json out.json 同时把结果保存为 JSON
+    python bench.py --compare base.json
+                                    与之前保存的结果比较，变慢超过阈值时返回非零
+
+handle_message、broadcast、voting、next_turn 在进程内运行：服务器不监听端口，
+连接是只编码帧、统计字节数的假连接，测到的是服务器逻辑自身的开销。
+loopback 启动真正的服务器（线程和 asyncio 模式），客户端经 127.0.0.1 连接，
+测的是一条聊天消息从发出到房间里所有人收到的端到端延迟
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import socket
+import sys
+import time
+import timeit
+from collections import deque
+
+import main
+
+
+def make_players(count):
+    return [
+        {"id": i, "name": f"玩家{i}", "is_host": i == 1} for i in range(1, count + 1)
+    ]
+
+
+# 每种消息类型的典型内容（8 人房间）
+SAMPLE_MESSAGES = {
+    "join": {"type": "join", "name": "小明", "is_host": False, "protocols": ["bin1"]},
+    "start_game": {"type": "start_game"},
+    "vote": {"type": "vote", "target_id": 3},
+    "send_message": {"type": "send_message", "message": "这是一种水果，红色的"},
+    "chat_message": {"type": "chat_message", "message": "我觉得三号很可疑"},
+    "player_list": {
+        "type": "player_list",
+        "players": make_players(7),
+        "your_id": 8,
+        "is_host": False,
+        "protocol": "bin1",
+    },
+    "player_joined": {
+        "type": "player_joined",
+        "id": 8,
+        "name": "小明",
+        "is_host": False,
+    },
+    "player_left": {"type": "player_left", "player_id": 8, "player_name": "小明"},
+    "game_start": {
+        "type": "game_start",
+        "your_id": 1,
+        "word": "苹果",
+        "is_undercover": False,
+        "players": make_players(8),
+    },
+    "next_turn": {"type": "next_turn", "current_turn": 3},
+    "voting_start": {"type": "voting_start"},
+    "vote_progress": {
+        "type": "vote_progress",
+        "voted": 5,
+        "total": 8,
+        "counts": [[3, 3], [5, 2]],
+    },
+    "vote_result": {"type": "vote_result", "eliminated": 3, "counts": [[3, 5], [5, 3]]},
+    "new_message": {"type": "new_message", "player_id": 2, "message": "这是一种水果"},
+    "game_over": {
+        "type": "game_over",
+        "winner": "平民",
+        "undercover_id": 3,
+        "player_words": {i: "梨" if i == 3 else "苹果" for i in range(1, 9)},
+    },
+    "game_reset": {"type": "game_reset", "players": make_players(8)},
+}
+
+
+def time_call(func):
+    """返回每次调用的平均耗时（纳秒）"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=3, number=number))
+    return best / number * 1e9
+
+
+# 房间人数
+ROOM_SIZES = (4, 8, 16, 64, 100, 500)
+
+
+class NullConnection(main.ClientConnection):
+    """进程内的假连接：按协商的协议编码帧，只统计字节数，不写网络"""
+
+    def __init__(self):
+        super().__init__(("::1", 0), main.Backpressure(), main.WriteBatching())
+        self.bytes = 0
+
+    def send(self, message):
+        if self.closed:
+            return
+        admitted = self.admit(message)
+        if admitted:
+            self.bytes += len(admitted.frame(self.protocol))
+        elif admitted is None:
+            self.abort()
+
+
+class NullTimer:
+    def cancel(self):
+        pass
+
+
+class BenchServer(main.GameServer):
+    """不监听端口的服务器，计时器不会触发，测试结果不受后台线程影响"""
+
+    def call_later(self, delay, callback, *args):
+        return NullTimer()
+
+    def connect(self):
+        player_id = self.new_player_id()
+        self.clients[player_id] = NullConnection()
+        return player_id
+
+
+def make_room(size):
+    # 建一个有 size 个玩家（都支持二进制协议和增量同步）的房间，1 号是主机
+    server = BenchServer()
+    for i in range(size):
+        player_id = server.connect()
+        server.handle_message(
+            player_id,
+            {
+                "type": "join",
+                "name": f"玩家{player_id}",
+                "is_host": i == 0,
+                "protocols": main.SUPPORTED_PROTOCOLS,
+                "features": main.SUPPORTED_FEATURES,
+            },
+        )
+    room = server.rooms[server.DEFAULT_ROOM_ID]
+    # 不依赖磁盘上的词库，只测服务器逻辑
+    room.next_word_pair = lambda: ["苹果", "梨"]
+    return server, room
+
+
+def bench_handle_message():
+    """8 人房间中每种客户端消息经过 GameServer.handle_message 的耗时"""
+    server, room = make_room(8)
+    ids = list(room.player_info)
+    host = ids[0]
+
+    def playing():
+        room.game_state = main.GameState.PLAYING
+        room.turn_count = 0
+
+    def send_message():
+        playing()
+        server.handle_message(ids[room.current_turn], SAMPLE_MESSAGES["send_message"])
+
+    votes = [
+        {"type": "vote", "target_id": ids[1]},
+        {"type": "vote", "target_id": ids[2]},
+    ]
+
+    def vote():
+        # 同一个玩家来回改票，投票一直不会结束
+        room.game_state = main.GameState.VOTING
+        server.handle_message(host, votes[vote.count % 2])
+        vote.count += 1
+
+    vote.count = 0
+
+    def join():
+        player_id = server.connect()
+        server.handle_message(player_id, SAMPLE_MESSAGES["join"])
+        server.leave_room(player_id)
+        del server.clients[player_id]
+
+    def create_room():
+        server.handle_message(host, {"type": "create_room", "name": "测试"})
+        server.rooms.pop(str(server.next_room_id - 1))
+
+    def set_word_filter():
+        room.game_state = main.GameState.LOBBY
+        server.handle_message(
+            host, {"type": "set_word_filter", "filter": {"category": "水果"}}
+        )
+
+    cases = {
+        "start_game": lambda: server.handle_message(host, {"type": "start_game"}),
+        "send_message": send_message,
+        "chat_message": lambda: server.handle_message(
+            ids[1], SAMPLE_MESSAGES["chat_message"]
+        ),
+        "vote": vote,
+        "join+leave": join,
+        "list_rooms": lambda: server.handle_message(host, {"type": "list_rooms"}),
+        "create_room": create_room,
+        "set_word_filter": set_word_filter,
+        "resync": lambda: server.handle_message(host, {"type": "resync"}),
+        "restart_game": lambda: server.handle_message(host, {"type": "restart_game"}),
+    }
+    return {name: {"ns": time_call(case)} for name, case in cases.items()}
+
+
+def print_handle_message(results):
+    print("消息类型              ns")
+    for name, row in results.items():
+        print(f"{name:<16}{row['ns']:>10.0f}")
+
+
+def bench_broadcast():
+    """一条聊天消息广播给整个房间的耗时（编码一次，放入每个连接的队列）"""
+    results = {}
+    for size in ROOM_SIZES:
+        server, room = make_room(size)
+        data = SAMPLE_MESSAGES["new_message"]
+        ns = time_call(lambda: room.broadcast(data, droppable=True))
+        results[str(size)] = {"ns": ns, "ns_per_player": ns / size}
+    return results
+
+
+def print_broadcast(results):
+    print("房间人数          ns     每人ns")
+    for size, row in results.items():
+        print(f"{size:<8}{row['ns']:>12.0f}{row['ns_per_player']:>10.0f}")
+
+
+def bench_payload():
+    """game_start 和 game_over 的编码、解码耗时随房间人数的变化"""
+    results = {}
+    for size in ROOM_SIZES:
+        messages = {
+            "game_start": {
+                "type": "game_start",
+                "your_id": 1,
+                "word": "苹果",
+                "is_undercover": False,
+                "players": make_players(size),
+            },
+            "game_over": {
+                "type": "game_over",
+                "winner": "平民",
+                "undercover_id": 3,
+                "player_words": {
+                    i: "梨" if i == 3 else "苹果" for i in range(1, size + 1)
+                },
+            },
+        }
+        for name, message in messages.items():
+            row = {}
+            for protocol in (main.PROTOCOL_JSON, main.PROTOCOL_BINARY):
+                frame = main.encode_message(message, protocol)
+                row[protocol] = {
+                    "bytes": len(frame),
+                    "encode_ns": time_call(
+                        lambda: main.encode_message(message, protocol)
+                    ),
+                    "decode_ns": time_call(lambda: main.decode_frame(frame)),
+                }
+            results[f"{name}/{size}"] = row
+    return results
+
+
+def bench_voting():
+    """一轮投票：每个存活玩家投一票，最后一票触发结算"""
+    results = {}
+    for size in ROOM_SIZES:
+        server, room = make_room(size)
+        ids = list(room.player_info)
+        # 所有人投 1 号（1 号投 2 号），卧底是最后一个玩家，游戏继续
+        ballots = [
+            (pid, {"type": "vote", "target_id": ids[1] if pid == ids[0] else ids[0]})
+            for pid in ids
+        ]
+
+        def voting_round():
+            # 每轮都从所有人存活、没有选票的投票阶段开始
+            for info in room.player_info.values():
+                info["eliminated"] = False
+            room.alive_count = len(room.player_info)
+            room.tally.clear()
+            room.undercover_id = ids[-1]
+            room.game_state = main.GameState.VOTING
+            for pid, ballot in ballots:
+                room.handle_message(pid, ballot)
+
+        # 确认每一票都被接受，且恰好在最后一票结算
+        voting_round()
+        assert room.game_state == main.GameState.PLAYING and not room.tally
+        assert room.alive_count == size - 1
+        room.game_state = main.GameState.VOTING
+        room.alive_count = size
+        for info in room.player_info.values():
+            info["eliminated"] = False
+        for pid, ballot in ballots[:-1]:
+            room.handle_message(pid, ballot)
+        assert room.game_state == main.GameState.VOTING
+        assert len(room.tally) == size - 1
+
+        ns = time_call(voting_round)
+        results[str(size)] = {"ns": ns, "ns_per_vote": ns / size}
+    return results
+
+
+def print_voting(results):
+    print("房间人数          ns     每票ns")
+    for size, row in results.items():
+        print(f"{size:<8}{row['ns']:>12.0f}{row['ns_per_vote']:>10.0f}")
+
+
+def bench_next_turn():
+    """换到下一位玩家描述，并把状态增量发给房间里的所有人"""
+    results = {}
+    for size in ROOM_SIZES:
+        server, room = make_room(size)
+
+        def next_turn():
+            room.game_state = main.GameState.PLAYING
+            room.turn_count = 0
+            room.next_turn()
+
+        ns = time_call(next_turn)
+        results[str(size)] = {"ns": ns, "ns_per_player": ns / size}
+    return results
+
+
+# 回环测试：IPv6 监听套接字上的 127.0.0.1，不对外暴露端口
+LOOPBACK_HOST = "::ffff:127.0.0.1"
+LOOPBACK_SIZES = (4, 8, 16, 64)
+LOOPBACK_ROUNDS = 200
+
+
+class LoopbackClient:
+    """经 127.0.0.1 连接真实服务器的阻塞客户端，使用默认的 JSON 协议"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.frames = main.FrameReader()
+        self.messages = deque()
+
+    def send(self, data):
+        self.sock.sendall(main.encode_message(data))
+
+    def wait_for(self, predicate):
+        # 读到满足条件的消息为止，之前的消息丢弃
+        while True:
+            while self.messages:
+                message = self.messages.popleft()
+                if predicate(message):
+                    return message
+            if not self.frames.recv_from(self.sock):
+                raise ConnectionError("服务器关闭了连接")
+            for frame in self.frames.read_frames():
+                message = main.decode_frame(frame)
+                if message is not None:
+                    self.messages.append(message)
+
+    def close(self):
+        self.sock.close()
+
+
+def loopback_room(server, port, size):
+    """建一个新房间并让 size 个客户端加入，返回每轮聊天的延迟（秒）"""
+    clients = [LoopbackClient(port) for _ in range(size)]
+    try:
+        host = clients[0]
+        host.send({"type": "create_room", "name": "测试"})
+        room_id = host.wait_for(lambda m: m["type"] == "room_created")["room_id"]
+        for i, client in enumerate(clients):
+            client.send(
+                {
+                    "type": "join_room",
+                    "room_id": room_id,
+                    "name": f"玩家{i}",
+                    "is_host": i == 0,
+                }
+            )
+            client.wait_for(lambda m: m["type"] == "player_list")
+
+        def chat_round(text):
+            started = time.perf_counter()
+            host.send({"type": "chat_message", "message": text})
+            for client in clients:
+                client.wait_for(
+                    lambda m: m["type"] == "new_message" and m["message"] == text
+                )
+            return time.perf_counter() - started
+
+        # 第一轮把加入时的消息都读掉
+        chat_round("预热")
+        return [chat_round(f"消息{i}") for i in range(LOOPBACK_ROUNDS)]
+    finally:
+        for client in clients:
+            client.close()
+        # 等服务器处理完断开，房间回收后再开始下一组
+        deadline = time.perf_counter() + 5
+        while server.clients and time.perf_counter() < deadline:
+            time.sleep(0.01)
+
+
+def bench_loopback():
+    """真实服务器经 127.0.0.1 广播一条聊天消息，直到房间里最后一人收到的延迟"""
+    results = {}
+    # 服务器的连接日志不混进测试结果
+    with contextlib.redirect_stdout(io.StringIO()):
+        for mode in ("thread", "asyncio"):
+            # 端口 0 由系统分配；服务器线程是守护线程，随测试进程退出
+            server = main.create_server(mode, LOOPBACK_HOST, 0)
+            server.bind()
+            port = server.server_socket.getsockname()[1]
+            server.start()
+            for size in LOOPBACK_SIZES:
+                samples = sorted(loopback_room(server, port, size))
+                results[f"{mode}/{size}"] = {
+                    "p50_ns": samples[len(samples) // 2] * 1e9,
+                    "p99_ns": samples[int(len(samples) * 0.99)] * 1e9,
+                }
+    return results
+
+
+def print_loopback(results):
+    print("模式/人数             p50us     p99us")
+    for name, row in results.items():
+        print(f"{name:<16}{row['p50_ns'] / 1e3:>10.0f}{row['p99_ns'] / 1e3:>10.0f}")
+
+
+def bench_protocol():
+    results = {}
+    for name, message in SAMPLE_MESSAGES.items():
+        row = {}
+        for protocol in (main.PROTOCOL_JSON, main.PROTOCOL_BINARY):
+            frame = main.encode_message(message, protocol)
+            row[protocol] = {
+                "bytes": len(frame),
+                "encode_ns": time_call(lambda: main.encode_message(message, protocol)),
+                "decode_ns": time_call(lambda: main.decode_frame(frame)),
+            }
+        results[name] = row
+    return results
+
+
+def print_protocol(results):
+    print(
+        "消息类型        JSON字节  二进制字节   编码ns(JSON/二进制)  解码ns(JSON/二进制)"
+    )
+    for name, row in results.items():
+        js, bn = row[main.PROTOCOL_JSON], row[main.PROTOCOL_BINARY]
+        print(
+            f"{name:<16}{js['bytes']:>10}{bn['bytes']:>10}"
+            f"{js['encode_ns']:>9.0f}/{bn['encode_ns']:<7.0f}"
+            f"{js['decode_ns']:>9.0f}/{bn['decode_ns']:<7.0f}"
+        )
+
+
+# {名称: (运行函数, 打印函数)}
+SUITES = {
+    "protocol": (bench_protocol, print_protocol),
+    "payload": (bench_payload, print_protocol),
+    "handle_message": (bench_handle_message, print_handle_message),
+    "broadcast": (bench_broadcast, print_broadcast),
+    "voting": (bench_voting, print_voting),
+    "next_turn": (bench_next_turn, print_broadcast),
+    "loopback": (bench_loopback, print_loopback),
+}
+
+
+def timings(results, prefix=""):
+    """把嵌套的结果展开成 {路径: 纳秒}，只保留耗时字段"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(timings(value, path))
+        elif key.endswith("ns"):
+            flat[path] = value
+    return flat
+
+
+def compare(report, baseline, threshold):
+    """打印比基准慢了 threshold 以上的项目，返回变慢的项目数"""
+    current = timings(report["results"])
+    previous = timings(baseline["results"])
+    slower = 0
+    for path, ns in current.items():
+        before = previous.get(path)
+        if not before:
+            continue
+        change = ns / before - 1
+        if change > threshold:
+            slower += 1
+            print(f"变慢 {change:+.0%}: {path} {before:.0f} -> {ns:.0f} ns")
+    print(f"与基准比较了 {len(current.keys() & previous.keys())} 项，{slower} 项变慢")
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="谁是卧底服务器基准测试")
+    parser.add_argument("suites", nargs="*", help=f"可选: {', '.join(SUITES)}")
+    parser.add_argument("--json", help="把结果保存到指定的 JSON 文件")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果比较")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="判定为变慢的比例，默认 10%%"
+    )
+    args = parser.parse_args()
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error(f"未知的测试: {suite}")
+
+    report = {"python": sys.version.split()[0], "results": {}}
+    for suite in args.suites or SUITES:
+        run, show = SUITES[suite]
+        print(f"== {suite} ==")
+        report["results"][suite] = run()
+        show(report["results"][suite])
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
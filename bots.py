@@ -0,0 +1,468 @@
+"""
+无界面的机器人客户端和服务器压力测试
+
+    python bots.py --bots 1000 --room-size 8          连接本机已运行的服务器
+    python bots.py --spawn asyncio --duration 60       先启动一个服务器子进程
+    python bots.py --bots 200 --chat-rate 0.5 --json out.json
+
+每个机器人都是一个 asyncio 任务，按房间分组：第一个机器人创建房间并担任主机，
+人满后开始游戏，轮到自己时描述，投票阶段随机投票，平时按设定的频率聊天。
+结束后报告消息往返延迟的分位数、吞吐量和错误率。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import main
+
+
+def percentile(values, fraction):
+    # values 已排序
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+
+class LoadStats:
+    """所有机器人共享的统计，只在事件循环线程中修改"""
+
+    def __init__(self):
+        self.latencies = {}  # {操作: [秒]}
+        self.sent = 0
+        self.received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.requests = 0  # 需要服务器响应的操作数
+        self.errors = {}  # {错误类型: 次数}
+        self.games = 0
+        self.started = time.perf_counter()
+
+    def latency(self, kind, seconds):
+        self.latencies.setdefault(kind, []).append(seconds)
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = {}
+        for kind, values in self.latencies.items():
+            values = sorted(values)
+            latencies[kind] = {
+                "count": len(values),
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p90_ms": percentile(values, 0.90) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        errors = sum(self.errors.values())
+        return {
+            "elapsed": elapsed,
+            "games": self.games,
+            "sent": self.sent,
+            "received": self.received,
+            "sent_per_second": self.sent / elapsed,
+            "received_per_second": self.received / elapsed,
+            "bytes_per_second": (self.bytes_sent + self.bytes_received) / elapsed,
+            "latency": latencies,
+            "errors": self.errors,
+            "error_rate": errors / self.requests if self.requests else 0.0,
+        }
+
+
+def print_report(report):
+    print(
+        f"用时 {report['elapsed']:.1f}s, 完成 {report['games']} 局, "
+        f"发送 {report['sent']} 条 ({report['sent_per_second']:.0f}/s), "
+        f"接收 {report['received']} 条 ({report['received_per_second']:.0f}/s), "
+        f"{report['bytes_per_second'] / 1024:.0f} KB/s"
+    )
+    print("操作          次数      p50ms     p90ms     p99ms     最大ms")
+    for kind, row in report["latency"].items():
+        print(
+            f"{kind:<12}{row['count']:>6}{row['p50_ms']:>10.1f}{row['p90_ms']:>10.1f}"
+            f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}"
+        )
+    print(f"错误率 {report['error_rate']:.2%}: {report['errors'] or '无'}")
+
+
+class Bot:
+    """
+    一个模拟玩家。只维护打牌需要的那部分房间状态（玩家顺序、阶段、当前回合），
+    和图形客户端一样默认使用 JSON 协议和增量同步，--protocol bin1 时改用二进制协议
+    """
+
+    def __init__(
+        self,
+        name,
+        stats,
+        chat_rate=0.0,
+        think_time=(0.05, 0.3),
+        protocol=main.PROTOCOL_JSON,
+    ):
+        self.name = name
+        self.stats = stats
+        self.chat_rate = chat_rate  # 每秒聊天条数
+        self.think_time = think_time  # 每次行动前的随机等待（秒）
+        self.reader = None
+        self.writer = None
+        self.protocol = main.PROTOCOL_JSON  # 加入后按服务器告知的协议发送
+        self.preferred_protocol = protocol  # 加入时请求的协议
+        self.frames = main.FrameReader()
+
+        self.my_id = None
+        self.is_host = False
+        self.room_size = 0
+        self.seq = None
+        self.players = []  # [[id, 是否淘汰]]，与服务器的回合顺序一致
+        self.phase = main.GameState.LOBBY.name
+        self.current_turn = 0
+        self.turn_count = 0
+        self.described = None  # 已经描述过的回合 (turn_count, current_turn)
+        self.voted = False
+
+        self.pending = {}  # {标记: (操作, 发送时间)}，等待服务器回显
+        self.next_mark = 0
+        self.changed = asyncio.Event()
+        self.room_created = None  # 等待 room_created 的 Future
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    def send(self, data):
+        frame = main.encode_message(data, self.protocol)
+        self.writer.write(frame)
+        self.stats.sent += 1
+        self.stats.bytes_sent += len(frame)
+
+    def request(self, kind, data, mark=None):
+        # 记下发送时间，收到对应回复时计算延迟
+        self.stats.requests += 1
+        self.pending[mark if mark is not None else kind] = (
+            kind,
+            time.perf_counter(),
+        )
+        self.send(data)
+
+    def answered(self, mark):
+        entry = self.pending.pop(mark, None)
+        if entry is not None:
+            kind, started = entry
+            self.stats.latency(kind, time.perf_counter() - started)
+
+    def tagged(self, text):
+        # 描述和聊天内容带上编号，收到自己的消息时按编号匹配
+        self.next_mark += 1
+        mark = f"#{self.next_mark}"
+        return mark, f"{text} {mark}"
+
+    async def create_room(self, name):
+        self.room_created = asyncio.get_running_loop().create_future()
+        self.request("create_room", {"type": "create_room", "name": name})
+        return await self.room_created
+
+    def join(self, room_id, is_host, room_size):
+        self.is_host = is_host
+        self.room_size = room_size
+        self.request(
+            "join",
+            {
+                "type": "join_room",
+                "room_id": room_id,
+                "name": self.name,
+                "is_host": is_host,
+                "protocols": [self.preferred_protocol],
+                "features": main.SUPPORTED_FEATURES,
+            },
+        )
+
+    async def read_loop(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.stats.bytes_received += len(data)
+            self.frames.feed(data)
+            for frame in self.frames.read_frames():
+                message = main.decode_frame(frame)
+                if message is not None:
+                    self.stats.received += 1
+                    self.handle_message(message)
+            self.changed.set()
+
+    def handle_message(self, message):
+        msg_type = message.get("type")
+        if msg_type == "player_list":
+            self.my_id = message["your_id"]
+            self.protocol = message.get("protocol", self.protocol)
+            self.answered("join")
+        elif msg_type == "room_created":
+            self.answered("create_room")
+            if self.room_created is not None and not self.room_created.done():
+                self.room_created.set_result(message["room_id"])
+        elif msg_type == "state_snapshot":
+            state = message["state"]
+            self.players = [[pid, out] for pid, _, _, out in state["players"]]
+            self.phase = state["phase"]
+            self.current_turn = state["current_turn"]
+            self.turn_count = state["turn_count"]
+            self.seq = message["seq"]
+        elif msg_type == "state_delta":
+            self.apply_delta(message["seq"], message["ops"])
+        elif msg_type == "new_message":
+            if message["player_id"] == self.my_id:
+                self.answered(message["message"].rpartition(" ")[2])
+        elif msg_type == "game_over":
+            if self.is_host:
+                self.stats.games += 1
+        elif msg_type == "error":
+            self.stats.error(message.get("message", "error"))
+
+    def apply_delta(self, seq, ops):
+        if self.seq is None or seq <= self.seq:
+            return
+        if seq != self.seq + 1:
+            # 中间丢了增量，请求完整快照
+            self.stats.error("gap")
+            self.seq = None
+            self.send({"type": "resync"})
+            return
+        for op in ops:
+            kind = op[0]
+            if kind == "join":
+                if not any(p[0] == op[1] for p in self.players):
+                    self.players.append([op[1], False])
+            elif kind == "leave":
+                self.players = [p for p in self.players if p[0] != op[1]]
+            elif kind == "out":
+                for player in self.players:
+                    if player[0] == op[1]:
+                        player[1] = True
+            elif kind == "turn":
+                _, self.current_turn, self.turn_count = op
+            elif kind == "phase":
+                self.phase = op[1]
+                self.voted = False
+            elif kind == "clear_votes":
+                self.voted = False
+            elif kind == "reset":
+                self.phase = main.GameState.LOBBY.name
+                self.players = [[p[0], False] for p in self.players]
+                self.described = None
+        self.seq = seq
+
+    def next_action(self):
+        """根据当前状态决定要发送的消息，没有要做的事时返回 None"""
+        if self.seq is None:
+            return None
+        if self.phase == "LOBBY":
+            if self.is_host and len(self.players) >= self.room_size:
+                return "start_game", {"type": "start_game"}
+        elif self.phase == "PLAYING":
+            turn = (self.turn_count, self.current_turn)
+            if (
+                self.current_turn < len(self.players)
+                and self.players[self.current_turn][0] == self.my_id
+                and self.described != turn
+            ):
+                self.described = turn
+                return "describe", {"type": "send_message", "message": "描述"}
+        elif self.phase == "VOTING":
+            me = next((p for p in self.players if p[0] == self.my_id), None)
+            targets = [p[0] for p in self.players if not p[1] and p[0] != self.my_id]
+            if not self.voted and me is not None and not me[1] and targets:
+                self.voted = True
+                return "vote", {"type": "vote", "target_id": random.choice(targets)}
+        elif self.phase == "RESULT":
+            if self.is_host:
+                return "restart_game", {"type": "restart_game"}
+        return None
+
+    async def play_loop(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            await asyncio.sleep(random.uniform(*self.think_time))
+            action = self.next_action()
+            if action is None:
+                continue
+            kind, data = action
+            if kind == "describe":
+                mark, data["message"] = self.tagged(data["message"])
+                self.request(kind, data, mark)
+            else:
+                # 这些操作的回复是合并的状态增量，只统计次数
+                self.send(data)
+            if kind in ("start_game", "restart_game"):
+                # 等待服务器发来新的阶段，避免重复发送
+                self.phase = None
+            self.changed.set()
+
+    async def chat_loop(self):
+        # 泊松过程：间隔服从指数分布，平均每秒 chat_rate 条
+        while True:
+            await asyncio.sleep(random.expovariate(self.chat_rate))
+            if self.seq is not None:
+                mark, text = self.tagged("聊天")
+                self.request("chat", {"type": "chat_message", "message": text}, mark)
+
+    async def run(self):
+        tasks = [asyncio.ensure_future(self.play_loop())]
+        if self.chat_rate > 0:
+            tasks.append(asyncio.ensure_future(self.chat_loop()))
+        try:
+            await self.read_loop()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self.send({"type": "quit"})
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (OSError, RuntimeError):
+            pass
+
+
+async def run_room(index, host, port, room_size, stats, options, stopping):
+    bots = [
+        Bot(f"机器人{index}-{i}", stats, options.chat_rate, protocol=options.protocol)
+        for i in range(room_size)
+    ]
+    tasks = []
+    try:
+        for i, bot in enumerate(bots):
+            try:
+                await bot.connect(host, port)
+            except OSError as e:
+                stats.error(f"connect: {e.strerror or e}")
+                return
+            tasks.append(asyncio.ensure_future(bot.run()))
+            if i == 0:
+                room_id = await asyncio.wait_for(
+                    bot.create_room(f"压测 {index}"), options.timeout
+                )
+            bot.join(room_id, i == 0, room_size)
+        await stopping.wait()
+    except asyncio.TimeoutError:
+        stats.error("timeout")
+    finally:
+        # 测试结束前就断开的连接
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                error = task.exception()
+                stats.error(f"disconnect: {error}" if error else "disconnect")
+        # 超时还没等到回复的请求
+        now = time.perf_counter()
+        for bot in bots:
+            for _, started in bot.pending.values():
+                if now - started > options.timeout:
+                    stats.error("timeout")
+        for bot in bots:
+            await bot.close()
+        for task in tasks:
+            task.cancel()
+
+
+async def run_load(options):
+    stats = LoadStats()
+    stopping = asyncio.Event()
+    rooms = -(-options.bots // options.room_size)
+    tasks = []
+    for index in range(rooms):
+        size = min(options.room_size, options.bots - index * options.room_size)
+        tasks.append(
+            asyncio.ensure_future(
+                run_room(
+                    index, options.host, options.port, size, stats, options, stopping
+                )
+            )
+        )
+        # 按连接速率错开各个房间的建立，避免监听队列溢出
+        await asyncio.sleep(size / options.connect_rate)
+    await asyncio.sleep(options.duration)
+    stopping.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return stats.report()
+
+
+def raise_file_limit():
+    # 每个机器人占用一个文件描述符，尽量提高软限制
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="谁是卧底服务器压力测试")
+    parser.add_argument("--host", default="::1", help="服务器地址")
+    parser.add_argument("--port", type=int, default=12345, help="服务器端口")
+    parser.add_argument(
+        "--spawn",
+        choices=sorted(main.SERVER_MODES),
+        help="先在子进程中启动指定模式的服务器",
+    )
+    parser.add_argument("--bots", type=int, default=100, help="机器人总数")
+    parser.add_argument("--room-size", type=int, default=8, help="每个房间的人数")
+    parser.add_argument("--duration", type=float, default=30, help="运行秒数")
+    parser.add_argument(
+        "--chat-rate", type=float, default=0.2, help="每个机器人每秒聊天条数"
+    )
+    parser.add_argument(
+        "--connect-rate", type=float, default=200, help="每秒建立的连接数"
+    )
+    parser.add_argument("--timeout", type=float, default=10, help="请求超时秒数")
+    parser.add_argument(
+        "--protocol",
+        choices=(main.PROTOCOL_JSON, main.PROTOCOL_BINARY),
+        default=main.PROTOCOL_JSON,
+        help="机器人使用的线路协议",
+    )
+    parser.add_argument("--json", help="把结果保存到指定的 JSON 文件")
+    options = parser.parse_args()
+    if options.room_size < 2:
+        parser.error("每个房间至少需要 2 人")
+
+    raise_file_limit()
+    server = None
+    if options.spawn:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+                "--server",
+                "--server-mode",
+                options.spawn,
+                "--host",
+                options.host,
+                "--port",
+                str(options.port),
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        time.sleep(1)
+    try:
+        report = asyncio.run(run_load(options))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_report(report)
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
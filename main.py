@@ -4,21 +4,33 @@ import random
 import socket
 import threading
 import json
+import errno
+import struct
+import asyncio
+import argparse
+import os
+import time
+import secrets
+import bisect
+import contextlib
+import itertools
+import multiprocessing
+from abc import ABC, abstractmethod
 from enum import Enum
-import pickle
-from cryptography.fernet import Fernet
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from text import TAG_FIELDS, Deck, WordBank, WordIndex
 
+try:
+    # 用于查询套接字中未读取的字节数，Windows 上没有
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
 
-def load_encrypted(filename, key):
-    f = Fernet(key)
-    with open(filename, "rb") as f_in:
-        encrypted = f_in.read()
-    data = f.decrypt(encrypted)
-    return pickle.loads(data)  # 反序列化回 Python 对象
-
-
-with open("data/KEY", "rb") as file:
-    word_pairs = load_encrypted("data/WORDS", file.read())
+# 词库在服务器第一次开局时才加载，只运行客户端时不会读取
+word_bank = WordBank()
+word_index = WordIndex()
 
 
 # 颜色定义
@@ -42,6 +54,241 @@ class GameState(Enum):
     RESULT = 4
 
 
+# 文本渲染缓存
+class TextCache:
+    """
+    缓存 font.render 的结果，按 (字体, 字号, 文本, 颜色, 抗锯齿) 区分，
+    超过条目数或内存上限时淘汰最久未使用的表面
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.surfaces = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, antialias, color, background=None):
+        key = (
+            font.name,
+            font.point_size,
+            font.bold,
+            font.italic,
+            font.underline,
+            text,
+            tuple(color),
+            antialias,
+            None if background is None else tuple(background),
+        )
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, antialias, color, background)
+        size = surface.get_width() * surface.get_height() * surface.get_bytesize()
+        self.surfaces[key] = surface
+        self.total_bytes += size
+
+        # 按 LRU 顺序淘汰，直到满足上限（至少保留刚渲染的这一项）
+        while len(self.surfaces) > 1 and (
+            len(self.surfaces) > self.max_entries or self.total_bytes > self.max_bytes
+        ):
+            _, old = self.surfaces.popitem(last=False)
+            self.total_bytes -= old.get_width() * old.get_height() * old.get_bytesize()
+
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+        self.total_bytes = 0
+
+
+text_cache = TextCache()
+
+
+# 字体管理
+class FontManager:
+    """每个 (字体文件, 字号) 只加载一次，之后共享同一个 Font 实例"""
+
+    def __init__(self, default_path="default.ttf"):
+        self.default_path = default_path
+        self.fonts = {}
+        self.load_count = 0  # 实际从磁盘加载字体的次数
+
+    def get(self, size, path=None):
+        key = (path or self.default_path, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.Font(key[0], size)
+            self.fonts[key] = font
+            self.load_count += 1
+        return font
+
+    def preload(self, sizes, path=None):
+        for size in sizes:
+            self.get(size, path)
+
+
+fonts = FontManager()
+
+
+# 网络线程收到消息后投递该事件，唤醒阻塞在 event.wait 上的主循环
+NETWORK_EVENT = pygame.event.custom_type()
+
+
+# 帧调度
+class FrameScheduler:
+    """
+    有输入或动画时按 max_fps 全速运行，空闲时阻塞在 pygame.event.wait 上，
+    直到有事件、网络消息或定时器（如光标闪烁）到期
+    """
+
+    def __init__(self, max_fps=60, idle_timeout_ms=1000, active_window_ms=500):
+        self.max_fps = max_fps
+        self.idle_timeout_ms = idle_timeout_ms  # 空闲时最长阻塞时间
+        self.active_window_ms = active_window_ms  # 最后一次输入后保持全速的时长
+        self.clock = pygame.time.Clock()
+        self.last_activity = 0
+
+    def is_busy(self):
+        return pygame.time.get_ticks() - self.last_activity < self.active_window_ms
+
+    def wait_events(self, timeout_ms=None):
+        if timeout_ms is None:
+            timeout_ms = self.idle_timeout_ms
+        if self.is_busy() or timeout_ms <= 0:
+            events = pygame.event.get()
+        else:
+            event = pygame.event.wait(timeout_ms)
+            events = [] if event.type == pygame.NOEVENT else [event]
+            events += pygame.event.get()
+
+        if any(e.type != NETWORK_EVENT for e in events):
+            self.last_activity = pygame.time.get_ticks()
+        return events
+
+    def tick(self):
+        # 只限制最高帧率；空闲阻塞后的第一帧不会额外等待
+        return self.clock.tick(self.max_fps)
+
+
+def notify_main_loop():
+    # 没有窗口（例如纯服务器进程）时事件系统不可用
+    if pygame.display.get_init():
+        try:
+            pygame.event.post(pygame.event.Event(NETWORK_EVENT))
+        except pygame.error:
+            pass
+
+
+# 性能面板：F3 切换，显示帧耗时曲线、各阶段耗时、网络往返时间和积压
+class PerfOverlay:
+    def __init__(self, history=120, smoothing=0.1):
+        self.visible = False
+        self.history = deque(maxlen=history)  # 最近每帧的耗时（毫秒）
+        self.smoothing = smoothing
+        self.current = {}  # 本帧各阶段累计的秒数
+        self.sections = {}  # {阶段: 平滑后的毫秒数}
+        self.frame_started = time.perf_counter()
+        self.last_ping = 0.0
+        self.lines = []
+        self.rect = pygame.Rect(0, 0, 300, 0)
+        self.graph_height = 50
+
+    def add(self, name, seconds):
+        # 同一阶段在一帧里可能执行多次（例如按脏矩形重绘），累加后在帧末提交
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def record(self, name, started):
+        self.add(name, time.perf_counter() - started)
+
+    def end_frame(self):
+        now = time.perf_counter()
+        self.history.append((now - self.frame_started) * 1000)
+        self.frame_started = now
+        for name in self.sections.keys() | self.current.keys():
+            value = self.current.get(name, 0.0) * 1000
+            previous = self.sections.get(name, value)
+            self.sections[name] = previous + (value - previous) * self.smoothing
+        self.current = {}
+
+    def should_ping(self, interval=1.0):
+        now = time.monotonic()
+        if now - self.last_ping >= interval:
+            self.last_ping = now
+            return True
+        return False
+
+    def layout(self, surface, network):
+        """
+        生成本帧要显示的文字并算出面板位置，返回面板矩形。
+        面板高度随行数变化，局部重绘需要在画之前知道新的位置
+        """
+        font = fonts.get(18)
+        lines = []
+        if self.history:
+            frames = sorted(self.history)
+            lines.append(
+                f"帧耗时 {self.history[-1]:.1f}ms  "
+                f"p50 {frames[len(frames) // 2]:.1f}  最大 {frames[-1]:.1f}"
+            )
+        for name, ms in sorted(self.sections.items(), key=lambda item: -item[1]):
+            lines.append(f"{name:<16}{ms:7.2f}ms")
+        rtt = network.rtt
+        lines.append("往返 " + (f"{rtt * 1000:.1f}ms" if rtt is not None else "-"))
+        frames, size = network.inbound_backlog()
+        lines.append(f"接收积压 {frames} 条 / {size} 字节")
+        # 字体应当只在启动时加载，加载次数持续增长说明有地方绕过了 fonts
+        lines.append(f"字体加载 {fonts.load_count} 次")
+
+        self.lines = lines
+        self.rect = pygame.Rect(
+            surface.get_width() - 310,
+            10,
+            300,
+            self.graph_height + 15 + font.get_linesize() * len(lines),
+        )
+        return self.rect
+
+    def draw(self, surface):
+        # 画 layout 算好的内容；数值每帧都在变化，直接渲染，不放进文本缓存
+        font = fonts.get(18)
+        graph_height = self.graph_height
+        line_height = font.get_linesize()
+        panel = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 180))
+
+        # 帧耗时柱状图，满高度为 50ms，黄线是 60fps 的 16.7ms
+        scale = graph_height / 50
+        bar_width = (self.rect.width - 10) / self.history.maxlen
+        for i, ms in enumerate(self.history):
+            height = min(graph_height, max(1, int(ms * scale)))
+            color = Colors.GREEN if ms <= 1000 / 60 else Colors.RED
+            pygame.draw.rect(
+                panel,
+                color,
+                (
+                    5 + i * bar_width,
+                    5 + graph_height - height,
+                    max(1, bar_width),
+                    height,
+                ),
+            )
+        target = 5 + graph_height - int(1000 / 60 * scale)
+        pygame.draw.line(
+            panel, (255, 255, 0), (5, target), (self.rect.width - 5, target)
+        )
+
+        for i, line in enumerate(self.lines):
+            text = font.render(line, True, Colors.WHITE)
+            panel.blit(text, (5, graph_height + 10 + i * line_height))
+        surface.blit(panel, self.rect)
+
+
 # 输入框类
 class TextInputBox:
     def __init__(
@@ -71,9 +318,11 @@ class TextInputBox:
         self.cursor_switch_ms = 250
         self.cursor_ms_counter = 0
         self.cursor_position = 0  # 光标位置
+        self.dirty = True  # 外观有变化，需要重绘
 
     def handle_event(self, event):
         if event.type == pygame.TEXTINPUT and self.active:
+            self.dirty = True
             self.text = (
                 self.text[: self.cursor_position]
                 + event.text
@@ -82,12 +331,13 @@ class TextInputBox:
             self.cursor_position += len(event.text)
 
         elif event.type == pygame.MOUSEBUTTONDOWN:
-            if self.rect.collidepoint(event.pos):
-                self.active = True
-            else:
-                self.active = False
+            active = self.rect.collidepoint(event.pos)
+            if active != self.active:
+                self.active = active
+                self.dirty = True
 
         elif event.type == pygame.KEYDOWN and self.active:
+            self.dirty = True
             if event.key == pygame.K_RETURN:
                 self.done = True
                 if self.on_enter:
@@ -136,7 +386,10 @@ class TextInputBox:
             if self.cursor_ms_counter >= self.cursor_switch_ms:
                 self.cursor_ms_counter %= self.cursor_switch_ms
                 self.cursor_visible = not self.cursor_visible
+                self.dirty = True
         else:
+            if self.cursor_visible:
+                self.dirty = True
             self.cursor_visible = False
             self.cursor_ms_counter = 0
 
@@ -152,7 +405,7 @@ class TextInputBox:
             color = (150, 150, 150)
 
         # 渲染文本
-        text_surface = self.font.render(display_text, True, color)
+        text_surface = text_cache.render(self.font, display_text, True, color)
         text_pos = (
             self.rect.x + 5,
             self.rect.y + (self.rect.height - text_surface.get_height()) // 2,
@@ -184,6 +437,7 @@ class TextInputBox:
         self.done = False
         self.cursor_visible = True
         self.cursor_ms_counter = 0
+        self.dirty = True
 
 
 # 按钮类
@@ -207,10 +461,14 @@ class Button:
         self.text_color = text_color
         self.on_click = on_click
         self.hover = False
+        self.dirty = True  # 外观有变化，需要重绘
 
     def handle_event(self, event):
         if event.type == pygame.MOUSEMOTION:
-            self.hover = self.rect.collidepoint(event.pos)
+            hover = self.rect.collidepoint(event.pos)
+            if hover != self.hover:
+                self.hover = hover
+                self.dirty = True
         elif event.type == pygame.MOUSEBUTTONDOWN:
             if self.hover and self.on_click:
                 self.on_click()
@@ -227,13 +485,24 @@ class Button:
         pygame.draw.rect(surface, color, self.rect, border_radius=5)
         pygame.draw.rect(surface, Colors.BLACK, self.rect, 2, border_radius=5)
 
-        text_surface = self.font.render(self.text, True, self.text_color)
+        text_surface = text_cache.render(self.font, self.text, True, self.text_color)
         text_rect = text_surface.get_rect(center=self.rect.center)
         surface.blit(text_surface, text_rect)
 
 
 # 玩家类
 class Player:
+    __slots__ = (
+        "id",
+        "name",
+        "is_host",
+        "word",
+        "is_undercover",
+        "votes",
+        "eliminated",
+        "message",
+    )
+
     def __init__(self, _id, name, is_host=False):
         self.id = _id
         self.name = name
@@ -244,6 +513,10 @@ class Player:
         self.eliminated = False
         self.message = ""
 
+    def render_key(self):
+        # 玩家行中会随游戏进程变化的内容，变化时该行需要重绘
+        return self.message, self.eliminated, self.votes
+
     def draw(self, surface, x, y, width, height, is_me=False, game_state=None):
         # 绘制玩家框
         color = Colors.LIGHT_GRAY
@@ -258,49 +531,164 @@ class Player:
         )
 
         # 绘制玩家名称
-        font = pygame.font.Font("default.ttf", 24)
-        name_surface = font.render(self.name, True, Colors.BLACK)
+        font = fonts.get(24)
+        name_surface = text_cache.render(font, self.name, True, Colors.BLACK)
         surface.blit(name_surface, (x + 10, y + 10))
 
         # 显示最新消息在名字后面
         if self.message and not self.eliminated:
-            msg_font = pygame.font.Font("default.ttf", 18)  # 小一点字体
+            msg_font = fonts.get(18)  # 小一点字体
             display_msg = self.message
             if len(display_msg) > 15:
                 display_msg = display_msg[:12] + "..."
-            msg_surface = msg_font.render(display_msg, True, (0, 100, 0))  # 深绿色
+            # 深绿色
+            msg_surface = text_cache.render(msg_font, display_msg, True, (0, 100, 0))
             surface.blit(
                 msg_surface, (x + 15 + name_surface.get_width(), y + 12)
             )  # 挨在名字后面
 
         # 显示主机标识
         if self.is_host:
-            host_surface = font.render("主机", True, Colors.BLUE)
+            host_surface = text_cache.render(font, "主机", True, Colors.BLUE)
             surface.blit(host_surface, (x + width - 60, y + 10))
 
         # 显示淘汰状态
         if self.eliminated:
-            eliminated_surface = font.render("已淘汰", True, Colors.RED)
+            eliminated_surface = text_cache.render(font, "已淘汰", True, Colors.RED)
             surface.blit(eliminated_surface, (x + 10, y + 40))
 
         # 显示投票数
         if game_state == GameState.VOTING or game_state == GameState.RESULT:
-            votes_surface = font.render(f"票数: {self.votes}", True, Colors.BLACK)
+            votes_surface = text_cache.render(
+                font, f"票数: {self.votes}", True, Colors.BLACK
+            )
             surface.blit(votes_surface, (x + width - 80, y + 40))
 
 
-# 游戏类
+# 客户端状态的版本号，所有 Game 实例共用一个计数器，换成新的 Game 后版本也不会重复
+STATE_VERSIONS = itertools.count(1)
+
+
+class PlayerRegistry:
+    """按 id 索引的玩家表，遍历和下标按座位顺序，同时缓存自己的玩家对象"""
+
+    def __init__(self):
+        self.by_id = {}
+        self.seats = []  # 座位顺序，与服务器的回合顺序一致
+        self.my_id = None
+        self.me = None
+
+    def __iter__(self):
+        return iter(self.seats)
+
+    def __len__(self):
+        return len(self.seats)
+
+    def __getitem__(self, index):
+        return self.seats[index]
+
+    def get(self, player_id):
+        return self.by_id.get(player_id)
+
+    def add(self, player):
+        old = self.by_id.get(player.id)
+        if old is None:
+            self.seats.append(player)
+        else:
+            # 同一个玩家重复加入时保留原来的座位
+            self.seats[self.seats.index(old)] = player
+        self.by_id[player.id] = player
+        if player.id == self.my_id:
+            self.me = player
+        return player
+
+    def remove(self, player_id):
+        player = self.by_id.pop(player_id, None)
+        if player is not None:
+            self.seats.remove(player)
+            if player is self.me:
+                self.me = None
+        return player
+
+    def clear(self):
+        self.by_id.clear()
+        self.seats.clear()
+        self.me = None
+
+    def set_me(self, player_id):
+        self.my_id = player_id
+        self.me = self.by_id.get(player_id)
+
+
+# 游戏类：客户端状态只在主线程中修改，每批修改后 commit 一次
 class Game:
     def __init__(self):
+        self.version = next(STATE_VERSIONS)
         self.state = GameState.LOBBY
-        self.players = []
-        self.my_id = None
+        self.players = PlayerRegistry()
         self.current_turn = 0
         self.turn_count = 0
-        self.votes = {}
+        self.voted = 0  # 服务器计票：已投票的人数
+        self.my_vote = None  # 自己本轮投给的玩家
         self.undercover_id = None
         self.winner = None
         self.chat_history = []
+        self.seq = None  # 已应用的房间状态版本，None 表示等待快照
+        self.word_filter = {}  # 房间的词条筛选条件
+        self.word_tags = {}  # 服务器词库中可选的标签 {标签: [取值]}
+
+    def commit(self):
+        # 一批修改完成，界面据此判断是否需要重新计算画面
+        self.version = next(STATE_VERSIONS)
+
+    @property
+    def my_id(self):
+        return self.players.my_id
+
+    @my_id.setter
+    def my_id(self, player_id):
+        self.players.set_me(player_id)
+
+    def get_player(self, player_id):
+        return self.players.get(player_id)
+
+    def current_player(self):
+        # 玩家离开后 current_turn 可能越界
+        if 0 <= self.current_turn < len(self.players):
+            return self.players[self.current_turn]
+        return None
+
+    def is_my_turn(self):
+        current = self.current_player()
+        return current is not None and current.id == self.my_id
+
+    def reset_round(self):
+        # 清空一局游戏的状态，保留玩家列表
+        for player in self.players:
+            player.eliminated = False
+            player.word = ""
+            player.is_undercover = False
+            player.votes = 0
+            player.message = ""
+        self.chat_history = []
+        self.clear_votes()
+        self.current_turn = 0
+        self.turn_count = 0
+        self.winner = None
+        self.undercover_id = None
+
+    def clear_votes(self):
+        for player in self.players:
+            player.votes = 0
+        self.voted = 0
+        self.my_vote = None
+
+    def set_tally(self, counts, voted):
+        # 票数以服务器的计票为准，客户端不自己统计
+        counts = dict(counts)
+        for player in self.players:
+            player.votes = counts.get(player.id, 0)
+        self.voted = voted
 
     def next_turn(self):
         # 找到下一个未淘汰的玩家
@@ -315,192 +703,610 @@ class Game:
         if self.turn_count >= len(self.players) * 2:
             self.state = GameState.VOTING
             # 重置投票
-            for player in self.players:
-                player.votes = 0
-            self.votes = {}
-
-    def vote(self, voter_id, target_id):
-        if voter_id in self.votes:
-            # 撤销之前的投票
-            prev_target = self.votes[voter_id]
-            for player in self.players:
-                if player.id == prev_target:
-                    player.votes -= 1
-                    break
-
-        # 记录新投票
+            self.clear_votes()
+
+
+# 线路协议：换行分隔的 JSON（旧客户端）和长度前缀的二进制帧，加入时协商。
+# 二进制帧: 4 字节大端长度 + 1 字节消息类型码 + 紧凑编码的字段。
+# 帧长度小于 16MB，所以二进制帧的第一个字节总是 0，而 JSON 行不会以 0 开头，
+# 接收方可以逐帧识别格式，协商前后混合收发也不会出错。
+# 二进制帧比 JSON 小 60% 左右，但编解码是纯 Python 实现，玩家较多的消息
+# 比 C 实现的 json 慢 2-4 倍，所以客户端默认仍使用 JSON，带宽紧张时再选择 bin1
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "bin1"
+SUPPORTED_PROTOCOLS = [PROTOCOL_BINARY]  # 服务器可以协商的非 JSON 协议
+# 可选功能，加入时协商。state_sync: 加入时收到一次完整快照，之后只收带序号的增量
+FEATURE_STATE_SYNC = "state_sync"
+SUPPORTED_FEATURES = [FEATURE_STATE_SYNC]
+MAX_FRAME_SIZE = (1 << 24) - 1
+MAX_NESTING = 32  # 二进制帧中列表和字典的最大嵌套层数
+
+MESSAGE_TYPES = (
+    # 客户端 -> 服务器
+    "join",
+    "start_game",
+    "vote",
+    "send_message",
+    "chat_message",
+    "restart_game",
+    "quit",
+    "list_rooms",
+    "create_room",
+    "join_room",
+    # 服务器 -> 客户端
+    "player_list",
+    "player_joined",
+    "player_left",
+    "game_start",
+    "next_turn",
+    "voting_start",
+    "new_message",
+    "player_eliminated",
+    "game_over",
+    "game_reset",
+    "room_list",
+    "room_created",
+    "error",
+    # 新增的类型只能追加在末尾，已有类型码保持不变
+    "state_snapshot",
+    "state_delta",
+    "resync",
+    "resume",
+    "resumed",
+    "resume_failed",
+    "set_word_filter",
+    "word_filter",
+    "list_word_tags",
+    "word_tags",
+    "vote_progress",
+    "vote_result",
+    "ping",
+    "pong",
+)
+MESSAGE_TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+
+# 常用字段名编码为 1 字节，其他字段名按字符串编码
+FIELD_NAMES = (
+    "id",
+    "name",
+    "is_host",
+    "room_id",
+    "target_id",
+    "voter_id",
+    "player_id",
+    "player_name",
+    "message",
+    "players",
+    "your_id",
+    "word",
+    "is_undercover",
+    "current_turn",
+    "winner",
+    "undercover_id",
+    "player_words",
+    "rooms",
+    "state",
+    "protocol",
+    "protocols",
+    "seq",
+    "ops",
+    "features",
+    "session",
+    "received",
+    "filter",
+    "tags",
+    "turn_count",
+    "voted",
+    "total",
+    "counts",
+    "eliminated",
+    "time",
+)
+FIELD_CODES = {name: code for code, name in enumerate(FIELD_NAMES)}
+
+# 值的类型标记
+(
+    _TAG_NONE,
+    _TAG_FALSE,
+    _TAG_TRUE,
+    _TAG_INT,
+    _TAG_STR,
+    _TAG_LIST,
+    _TAG_DICT,
+    _TAG_FIELD,
+    _TAG_FLOAT,
+) = range(9)
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("变长整数过长")
+
+
+def _encode_value(out, value):
+    if value is None:
+        out.append(_TAG_NONE)
+    elif value is True:
+        out.append(_TAG_TRUE)
+    elif value is False:
+        out.append(_TAG_FALSE)
+    elif isinstance(value, int):
+        out.append(_TAG_INT)
+        # zigzag 编码，让小的负数也只占一个字节
+        _write_varint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)
+    elif isinstance(value, str):
+        data = value.encode()
+        out.append(_TAG_STR)
+        _write_varint(out, len(data))
+        out += data
+    elif isinstance(value, (list, tuple)):
+        out.append(_TAG_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _encode_value(out, item)
+    elif isinstance(value, dict):
+        out.append(_TAG_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            code = FIELD_CODES.get(key)
+            if code is None:
+                _encode_value(out, key)
+            else:
+                out.append(_TAG_FIELD)
+                out.append(code)
+            _encode_value(out, item)
+    elif isinstance(value, float):
+        out.append(_TAG_FLOAT)
+        out += struct.pack(">d", value)
+    else:
+        raise TypeError(f"无法编码的类型: {type(value).__name__}")
+
+
+def _decode_value(buf, pos, depth=0):
+    tag = buf[pos]
+    pos += 1
+    if tag == _TAG_NONE:
+        return None, pos
+    if tag == _TAG_TRUE:
+        return True, pos
+    if tag == _TAG_FALSE:
+        return False, pos
+    if tag == _TAG_INT:
+        n, pos = _read_varint(buf, pos)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+    if tag == _TAG_STR:
+        length, pos = _read_varint(buf, pos)
+        if pos + length > len(buf):
+            raise ValueError("字符串超出帧长度")
+        return bytes(buf[pos : pos + length]).decode(), pos + length
+    if tag == _TAG_LIST or tag == _TAG_DICT:
+        if depth >= MAX_NESTING:
+            raise ValueError("嵌套层数过多")
+        length, pos = _read_varint(buf, pos)
+        # 每个元素至少占一个字节，长度不可能超过剩余的数据
+        if length > len(buf) - pos:
+            raise ValueError("元素个数超出帧长度")
+        if tag == _TAG_LIST:
+            items = []
+            for _ in range(length):
+                item, pos = _decode_value(buf, pos, depth + 1)
+                items.append(item)
+            return items, pos
+        result = {}
+        for _ in range(length):
+            key, pos = _decode_value(buf, pos, depth + 1)
+            if isinstance(key, (list, dict)):
+                raise ValueError("字典的键必须是标量")
+            result[key], pos = _decode_value(buf, pos, depth + 1)
+        return result, pos
+    if tag == _TAG_FIELD:
+        code = buf[pos]
+        if code >= len(FIELD_NAMES):
+            raise ValueError(f"未知的字段码: {code}")
+        return FIELD_NAMES[code], pos + 1
+    if tag == _TAG_FLOAT:
+        if pos + 8 > len(buf):
+            raise ValueError("浮点数超出帧长度")
+        return struct.unpack_from(">d", buf, pos)[0], pos + 8
+    raise ValueError(f"未知的类型标记: {tag}")
+
+
+def encode_message(data, protocol=PROTOCOL_JSON):
+    if protocol == PROTOCOL_BINARY:
+        code = MESSAGE_TYPE_CODES.get(data.get("type"))
+        # 没有类型码的消息仍按 JSON 发送，接收方会逐帧识别
+        if code is not None:
+            body = bytearray()
+            _encode_value(body, {k: v for k, v in data.items() if k != "type"})
+            return struct.pack(">IB", len(body) + 1, code) + body
+    # 在 JSON 消息末尾添加换行符作为分隔符
+    return (json.dumps(data) + "\n").encode()
+
+
+# 接收端分帧器，服务器和客户端共用
+class FrameReader:
+    """
+    数据直接 recv_into 到同一个 bytearray 中，用 memoryview 切出完整的帧，
+    半截的帧留在缓冲区里等待后续数据。已处理的数据只移动读指针，
+    需要空间时才把剩余数据整体前移，避免每条消息都重建缓冲区
+    """
+
+    def __init__(self, read_size=65536, max_frame_size=MAX_FRAME_SIZE, keep_size=None):
+        self.read_size = read_size
+        self.max_frame_size = max_frame_size
+        # 数据处理完后缓冲区不超过 keep_size 时保留复用，否则释放
+        self.keep_size = read_size if keep_size is None else keep_size
+        self.buffer = bytearray()
+        self.start = 0  # 未处理数据的起点
+        self.end = 0  # 有效数据的终点
+
+    def reserve(self, size):
+        # 保证缓冲区尾部至少有 size 字节的空闲空间
+        if len(self.buffer) - self.end >= size:
+            return
+        if not self.buffer:
+            self.buffer = bytearray(size)
+            return
+        if self.start:
+            # 长度不变的切片赋值，不会重新分配缓冲区
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.buffer[self.start : self.end]
+            self.start, self.end = 0, remaining
+        missing = size - (len(self.buffer) - self.end)
+        if missing > 0:
+            self.buffer.extend(bytes(missing))
+
+    def get_buffer(self):
+        self.reserve(self.read_size)
+        return memoryview(self.buffer)[self.end :]
+
+    def advance(self, size):
+        # 数据已经被写入 get_buffer 返回的空间
+        self.end += size
+
+    def recv_from(self, sock):
+        self.reserve(self.read_size)
+        with memoryview(self.buffer) as view:
+            size = sock.recv_into(view[self.end :], self.read_size)
+        self.end += size
+        return size
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end : self.end + len(data)] = data
+        self.end += len(data)
+
+    def read_frames(self):
+        """返回所有完整的帧（bytes），不完整的部分留到下一次"""
+        frames = []
+        buffer = self.buffer
+        pos, end = self.start, self.end
+        with memoryview(buffer) as view:
+            while pos < end:
+                if buffer[pos]:
+                    # JSON 行
+                    newline = buffer.find(b"\n", pos, end)
+                    if newline < 0:
+                        break
+                    frames.append(bytes(view[pos : newline + 1]))
+                    pos = newline + 1
+                else:
+                    # 二进制帧
+                    if end - pos < 4:
+                        break
+                    length = int.from_bytes(view[pos : pos + 4], "big")
+                    if length == 0 or length > self.max_frame_size:
+                        raise ValueError(f"二进制帧长度无效: {length}")
+                    if end - pos - 4 < length:
+                        break
+                    frames.append(bytes(view[pos : pos + 4 + length]))
+                    pos += 4 + length
+        self.start = pos
+
+        if self.start == self.end:
+            # 全部处理完，缓冲区过大时换成新的，释放内存
+            self.start = self.end = 0
+            if len(self.buffer) > self.keep_size:
+                self.buffer = bytearray()
+        elif self.end - self.start > self.max_frame_size:
+            raise ValueError("消息过长")
+        return frames
+
+    def pending(self):
+        # 还没有处理的原始数据
+        return bytes(self.buffer[self.start : self.end])
+
+
+def decode_frame(frame):
+    """
+    把一帧解码为消息字典，空行返回 None。
+    帧的内容来自网络，任何格式错误都统一抛出 ValueError
+    """
+    if frame[0]:
+        if frame.isspace():
+            return None
+        try:
+            message = json.loads(frame)
+        except RecursionError:
+            raise ValueError("嵌套层数过多") from None
+        if not isinstance(message, dict):
+            raise ValueError("消息必须是 JSON 对象")
+        return message
+
+    if len(frame) < 6:
+        raise ValueError("二进制帧过短")
+    code = frame[4]
+    if code >= len(MESSAGE_TYPES):
+        raise ValueError(f"未知的消息类型码: {code}")
+    try:
+        message, end = _decode_value(frame, 5)
+    except IndexError:
+        raise ValueError("二进制帧被截断") from None
+    if not isinstance(message, dict):
+        raise ValueError("消息必须是字典")
+    if end != len(frame):
+        raise ValueError("二进制帧末尾有多余的数据")
+    message["type"] = MESSAGE_TYPES[code]
+    return message
+
+
+# 增量计票：投票和改票都是 O(1)，得票数按桶分组，最高票的玩家随时可取
+class VoteTally:
+    def __init__(self):
+        self.votes = {}  # {voter_id: target_id}
+        self.counts = {}  # {target_id: 得票数}
+        self.buckets = {}  # {得票数: {target_id}}
+        self.max_count = 0
+
+    def __len__(self):
+        return len(self.votes)
+
+    def _move(self, target_id, delta):
+        count = self.counts.get(target_id, 0)
+        if count:
+            bucket = self.buckets[count]
+            bucket.discard(target_id)
+            if not bucket:
+                del self.buckets[count]
+        count += delta
+        if count:
+            self.counts[target_id] = count
+            self.buckets.setdefault(count, set()).add(target_id)
+        else:
+            del self.counts[target_id]
+
+        # 每次只变化一票，最高票的桶空了，新的最高票就是少一票的那个桶
+        if count > self.max_count:
+            self.max_count = count
+        elif self.max_count and self.max_count not in self.buckets:
+            self.max_count -= 1
+
+    def cast(self, voter_id, target_id):
+        """记录一票，返回票数是否有变化"""
+        previous = self.votes.get(voter_id)
+        if previous == target_id:
+            return False
+        if previous is not None:
+            self._move(previous, -1)
         self.votes[voter_id] = target_id
-        for player in self.players:
-            if player.id == target_id:
-                player.votes += 1
-                break
+        self._move(target_id, 1)
+        return True
 
+    def remove_voter(self, voter_id):
+        target_id = self.votes.pop(voter_id, None)
+        if target_id is not None:
+            self._move(target_id, -1)
 
-# 游戏服务器类
-class GameServer:
-    def __init__(self, host="::", port=12345):
-        self.undercover_id = None
-        self.votes = {}
-        self.player_info = {}  # {player_id: {"name": name, "is_host": bool}}
-        self.host = host
-        self.port = port
-        self.server_socket = None
-        self.clients = {}
-        self.next_id = 1
-        self.running = False
-        self.game_state = GameState.LOBBY
-        self.current_turn = 0
-        self.turn_count = 0
+    def remove_target(self, target_id):
+        # 投给该玩家的人需要重新投票
+        for voter_id in [v for v, t in self.votes.items() if t == target_id]:
+            self.remove_voter(voter_id)
 
-    def start(self):
-        self.server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        try:
-            self.server_socket.bind((self.host, self.port))
-        except OSError as e:
-            if e.errno == 48:
-                print("端口已被占用")
-                return
-        self.server_socket.listen(5)
-        self.running = True
-        print(f"服务器启动: {self.host}:{self.port}")
+    def leaders(self):
+        return self.buckets.get(self.max_count, set())
 
-        thread = threading.Thread(target=self.accept_clients)
-        thread.daemon = True
-        thread.start()
+    def pairs(self):
+        # JSON 对象的键只能是字符串，所以用 [[target_id, 票数]] 传输
+        return [[target_id, count] for target_id, count in self.counts.items()]
 
-    def accept_clients(self):
-        while self.running:
-            conn, ip = self.server_socket.accept()
-            player_id = self.next_id
-            self.next_id += 1
-            self.clients[player_id] = (conn, ip)
+    def clear(self):
+        self.votes.clear()
+        self.counts.clear()
+        self.buckets.clear()
+        self.max_count = 0
 
-            print(f"玩家 {player_id} 已连接: {ip}")
-            thread = threading.Thread(target=self.handle_client, args=(player_id, conn))
-            thread.daemon = True
-            thread.start()
 
-    def check_voting_result(self):
-        # 计算每个玩家的得票数
-        vote_counts = {}
-        for target_id in self.votes.values():
-            vote_counts[target_id] = vote_counts.get(target_id, 0) + 1
+# 房间类：一桌游戏的全部状态，消息只在房间内广播
+class Room:
+    # 投票进度的合并间隔（秒），这段时间内的多张票只广播一次进度
+    progress_interval = 0.2
 
-        # 找到得票最多的玩家
-        max_votes = max(vote_counts.values()) if vote_counts else 0
-        candidates = [pid for pid, votes in vote_counts.items() if votes == max_votes]
+    def __init__(self, server, room_id, name=""):
+        self.server = server
+        self.id = room_id
+        self.name = name
+        self.undercover_id = None
+        self.tally = VoteTally()
+        self.progress_timer = None
+        self.player_info = {}  # {player_id: {"name": name, "is_host": bool}}
+        self.alive_count = 0  # 未淘汰的玩家数，投票时不必每票遍历玩家
+        self.game_state = GameState.LOBBY
+        self.current_turn = 0
+        self.turn_count = 0
+        # 房间状态的版本号，每次状态变化加一
+        self.seq = 0
+        self.sync_players = set()  # 支持增量同步的玩家
+        # 本房间的词条牌堆，重新开始游戏时保留，发完一轮才会重复
+        self.deck = None
+        self.deck_key = None
+        self.word_filter = {}  # 主机选择的词条筛选条件 {标签: 取值}
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "players": len(self.player_info),
+            "state": self.game_state.name,
+        }
 
-        # 如果只有一个得票最多的玩家，淘汰该玩家
-        if len(candidates) == 1:
-            eliminated_id = candidates[0]
+    def send_to(self, player_id, data):
+        self.server.send_to(player_id, data)
 
-            # 标记被淘汰的玩家
-            for player_id in self.player_info:
-                if player_id == eliminated_id:
-                    self.player_info[player_id]["eliminated"] = True
-                    break
+    def broadcast(self, data, droppable=False):
+        # 只发给本房间的玩家，开销与房间人数成正比
+        self.server.broadcast_to(list(self.player_info.keys()), data, droppable)
 
-            # 检查游戏是否结束
-            if eliminated_id == self.undercover_id:
-                # 卧底被淘汰，平民胜利
-                # 广播游戏结果和所有玩家的词语
-                self.broadcast(
-                    {
-                        "type": "game_over",
-                        "winner": "平民",
-                        "undercover_id": self.undercover_id,
-                        "player_words": {
-                            pid: info.get("word", "")
-                            for pid, info in self.player_info.items()
-                        },
-                    }
-                )
-                self.game_state = GameState.RESULT
-            else:
-                # 检查是否卧底胜利（存活玩家≤2且卧底仍在游戏中）
-                alive_players = [
-                    pid
-                    for pid, info in self.player_info.items()
-                    if not info.get("eliminated", False)
-                ]
+    def snapshot(self):
+        """完整的房间状态，只包含所有人可见的部分"""
+        return {
+            "players": [
+                [pid, info["name"], info["is_host"], info.get("eliminated", False)]
+                for pid, info in self.player_info.items()
+            ],
+            "phase": self.game_state.name,
+            "current_turn": self.current_turn,
+            "turn_count": self.turn_count,
+            "tally": [self.tally.pairs(), len(self.tally)],
+            "filter": self.word_filter,
+        }
+
+    def send_snapshot(self, player_id):
+        self.send_to(
+            player_id,
+            {"type": "state_snapshot", "seq": self.seq, "state": self.snapshot()},
+        )
 
-                if len(alive_players) <= 2 and self.undercover_id in alive_players:
-                    # 卧底胜利
-                    self.broadcast(
-                        {
-                            "type": "game_over",
-                            "winner": "卧底",
-                            "undercover_id": self.undercover_id,
-                            "player_words": {
-                                pid: info.get("word", "")
-                                for pid, info in self.player_info.items()
-                            },
-                        }
+    def publish(self, ops, *legacy):
+        """
+        发布一次状态变化：支持增量同步的玩家收到带序号的增量，
+        其他玩家收到原来的消息（可能没有对应的旧消息）
+        """
+        self.seq += 1
+        sync_ids, legacy_ids = [], []
+        for pid in self.player_info:
+            (sync_ids if pid in self.sync_players else legacy_ids).append(pid)
+        if sync_ids:
+            snapshot = []
+
+            def resync():
+                # 拥塞的连接用最新快照代替增量，同一次发布中共享一份
+                if not snapshot:
+                    snapshot.append(
+                        OutboundMessage(
+                            {
+                                "type": "state_snapshot",
+                                "seq": self.seq,
+                                "state": self.snapshot(),
+                            }
+                        )
                     )
-                    self.game_state = GameState.RESULT
-                else:
-                    # 游戏继续，进入下一轮
-                    self.next_turn()
-        else:
-            # 平票，继续游戏
-            self.next_turn()
-
-        # 清空投票记录
-        self.votes = {}
+                return snapshot[0]
 
-    def handle_client(self, player_id, conn):
-        buffer = ""  # 用于累积接收的数据
-        while self.running:
-            try:
-                data = conn.recv(1024).decode()
-                if not data:
-                    break
+            self.server.broadcast_to(
+                sync_ids,
+                {"type": "state_delta", "seq": self.seq, "ops": ops},
+                resync=resync,
+            )
+        if legacy_ids:
+            for data in legacy:
+                self.server.broadcast_to(legacy_ids, data)
+
+    def add_player(self, player_id, name, is_host):
+        # 检查是否已经有主机
+        existing_host = any(
+            info.get("is_host", False) for info in self.player_info.values()
+        )
+        if is_host and existing_host:
+            # 已经有主机了，不允许再设置为主机
+            is_host = False
+            # 通知客户端
+            self.send_to(
+                player_id,
+                {
+                    "type": "error",
+                    "message": "已经有主机存在，您已作为普通玩家加入",
+                },
+            )
 
-                buffer += data
-                # 按换行符分割消息
-                while "\n" in buffer:
-                    message_str, buffer = buffer.split("\n", 1)
-                    try:
-                        message = json.loads(message_str)
-                        self.handle_message(player_id, message)
-                    except json.JSONDecodeError as e:
-                        print(f"JSON 解析错误: {e}")
-            except Exception as e:
-                print(f"客户端错误: {e}")
-                break
+        # 保存玩家信息；同一连接重复加入时覆盖原来的记录，不重复计数
+        previous = self.player_info.get(player_id)
+        if previous is None or previous.get("eliminated", False):
+            self.alive_count += 1
+        self.player_info[player_id] = {"name": name, "is_host": is_host}
+        self.server.room_changed(self)
+
+        reply = {
+            "type": "player_list",
+            "your_id": player_id,
+            "is_host": is_host,  # 告诉客户端它的主机状态
+            "protocol": self.server.get_protocol(player_id),
+            # 断线重连用的会话令牌，这条消息是会话记录的第一条
+            "session": self.server.open_session(player_id),
+        }
+        if self.server.has_feature(player_id, FEATURE_STATE_SYNC):
+            # 发送一次完整快照，之后只发增量
+            self.sync_players.add(player_id)
+            self.send_to(player_id, reply)
+            self.send_snapshot(player_id)
+        else:
+            # 给新玩家发送已有玩家列表
+            reply["players"] = [
+                {"id": pid, "name": info["name"], "is_host": info["is_host"]}
+                for pid, info in self.player_info.items()
+                if pid != player_id
+            ]
+            self.send_to(player_id, reply)
 
-        # 客户端断开连接的处理
-        print(f"玩家 {player_id} 断开连接")
-        conn.close()
+        # 广播新玩家加入
+        self.publish(
+            [["join", player_id, name, is_host]],
+            {
+                "type": "player_joined",
+                "id": player_id,
+                "name": name,
+                "is_host": is_host,
+            },
+        )
 
+    def remove_player(self, player_id):
         # 如果玩家在玩家列表中，移除并广播
         if player_id in self.player_info:
-            player_name = self.player_info[player_id]["name"]
-            del self.player_info[player_id]
+            info = self.player_info.pop(player_id)
+            player_name = info["name"]
+            if not info.get("eliminated", False):
+                self.alive_count -= 1
+            self.sync_players.discard(player_id)
+            self.server.room_changed(self)
 
             # 广播玩家离开消息
-            self.broadcast(
+            self.publish(
+                [["leave", player_id]],
                 {
                     "type": "player_left",
                     "player_id": player_id,
                     "player_name": player_name,
-                }
+                },
             )
 
-        # 从客户端列表中移除
-        if player_id in self.clients:
-            del self.clients[player_id]
-
         # 如果游戏正在进行中，检查游戏状态
         if self.game_state == GameState.PLAYING or self.game_state == GameState.VOTING:
             # 检查是否还有足够的玩家继续游戏
-            active_players = [
-                pid
-                for pid, info in self.player_info.items()
-                if not info.get("eliminated", False)
-            ]
-
-            if len(active_players) < 2:
+            if self.alive_count < 2:
                 # 玩家不足，结束游戏
                 self.broadcast(
                     {
@@ -513,6 +1319,16 @@ class GameServer:
                     }
                 )
                 self.game_state = GameState.RESULT
+                self.cancel_vote_progress()
+                self.tally.clear()
+            elif self.game_state == GameState.VOTING:
+                # 作废离开玩家投出和收到的票，剩下的人都投完了就结算
+                self.tally.remove_voter(player_id)
+                self.tally.remove_target(player_id)
+                if len(self.tally) >= self.alive_count:
+                    self.finish_voting()
+                else:
+                    self.schedule_vote_progress()
             else:
                 # 如果退出的是当前回合的玩家，切换到下一个玩家
                 player_ids = list(self.player_info.keys())
@@ -525,214 +1341,1746 @@ class GameServer:
     def handle_message(self, player_id, message):
         msg_type = message.get("type")
 
-        if msg_type == "join":
-            name = message["name"]
-            is_host = message.get("is_host", False)
-
-            # 检查是否已经有主机
-            existing_host = any(
-                info.get("is_host", False) for info in self.player_info.values()
-            )
-            if is_host and existing_host:
-                # 已经有主机了，不允许再设置为主机
-                is_host = False
-                # 通知客户端
-                self.send_to(
-                    player_id,
-                    {
-                        "type": "error",
-                        "message": "已经有主机存在，您已作为普通玩家加入",
-                    },
-                )
+        if msg_type == "start_game":
+            # 只有主机可以开始游戏；一局结束后要先 restart_game 回到等待房间，
+            # 那里会清除淘汰状态和存活人数
+            if (
+                not self.player_info[player_id]["is_host"]
+                or self.game_state != GameState.LOBBY
+            ):
+                return
+
+            # 只解密选中的这一条词条所在的记录块
+            try:
+                word_pair = self.next_word_pair()
+            except Exception as e:
+                print(f"词库加载失败: {e}")
+                self.send_to(player_id, {"type": "error", "message": "词库不可用"})
+                return
+
+            self.game_state = GameState.PLAYING
+
+            # 获取所有玩家ID
+            player_ids = list(self.player_info.keys())
+            if not player_ids:
+                return
+
+            # 随机选择卧底
+            self.undercover_id = random.choice(player_ids)  # 保存卧底ID
+            players = [
+                {"id": p_id, "name": p_info["name"], "is_host": p_info["is_host"]}
+                for p_id, p_info in self.player_info.items()
+            ]
+
+            # 分配词语并通知所有玩家
+            for pid in player_ids:
+                is_undercover = pid == self.undercover_id  # 使用保存的卧底ID
+                word = word_pair[1] if is_undercover else word_pair[0]
+
+                # 保存玩家的词语信息
+                self.player_info[pid]["word"] = word
+                self.player_info[pid]["is_undercover"] = is_undercover
+
+                msg = {
+                    "type": "game_start",
+                    "your_id": pid,
+                    "word": word,
+                    "is_undercover": is_undercover,
+                }
+                if pid not in self.sync_players:
+                    # 增量同步的客户端已经有玩家列表，不需要重建
+                    msg["players"] = players
+                self.send_to(pid, msg)
+
+            # 设置第一个回合
+            self.current_turn = 0
+            self.turn_count = 0
+            self.publish(
+                [["phase", self.game_state.name], ["turn", 0, 0]],
+                {"type": "next_turn", "current_turn": 0, "turn_count": 0},
+            )
+
+        elif msg_type == "vote":
+            target_id = message.get("target_id")
+            # 只有存活的玩家能投票，只能投给其他存活的玩家
+            if (
+                self.game_state != GameState.VOTING
+                or target_id == player_id
+                or not self.is_alive(player_id)
+                or not self.is_alive(target_id)
+            ):
+                return
+            if not self.tally.cast(player_id, target_id):
+                return
+
+            # 所有存活玩家都投完票时直接结算，否则稍后合并广播一次进度
+            if len(self.tally) >= self.alive_count:
+                self.finish_voting()
+            else:
+                self.schedule_vote_progress()
+
+        elif msg_type == "send_message":
+            # 只在描述阶段，检查是否是当前回合的玩家
+            if self.game_state != GameState.PLAYING:
+                return
+            player_ids = list(self.player_info.keys())
+            if (
+                self.current_turn >= len(player_ids)
+                or player_ids[self.current_turn] != player_id
+            ):
+                return
+
+            text = message["message"]
+            self.broadcast(
+                {"type": "new_message", "player_id": player_id, "message": text}
+            )
+
+            # 切换到下一个回合
+            self.next_turn()
+
+        elif msg_type == "chat_message":
+            text = message["message"]
+            # 广播聊天消息给所有玩家，客户端拥塞时可以丢弃
+            self.broadcast(
+                {"type": "new_message", "player_id": player_id, "message": text},
+                droppable=True,
+            )
+
+        elif msg_type == "set_word_filter":
+            # 只有主机可以在等待房间里选择词条范围
+            if (
+                self.player_info[player_id]["is_host"]
+                and self.game_state == GameState.LOBBY
+            ):
+                self.set_word_filter(player_id, message.get("filter"))
+
+        elif msg_type == "resync":
+            # 客户端发现增量有缺口，重新发送完整快照
+            self.send_snapshot(player_id)
+
+        elif msg_type == "quit":
+            # 正常退出，不需要额外处理，连接会在handle_client中关闭
+            pass
+
+        elif msg_type == "restart_game":
+            # 只有主机可以重新开始游戏
+            if not self.player_info[player_id]["is_host"]:
+                return
+
+            # 重置游戏
+            self.reset_game()
+
+    def next_word_pair(self):
+        # 按筛选条件取出候选词条，交集由索引缓存，不会每局扫描词库
+        candidates = word_index.select(self.word_filter)
+        size = len(word_bank) if candidates is None else len(candidates)
+        deck_key = (tuple(sorted(self.word_filter.items())), size)
+        if self.deck is None or self.deck_key != deck_key:
+            # 词库或筛选条件变化后重新洗牌
+            self.deck = Deck(size)
+            self.deck_key = deck_key
+        index = self.deck.deal()
+        return word_bank[index if candidates is None else candidates[index]]
+
+    def set_word_filter(self, player_id, word_filter):
+        if not isinstance(word_filter, dict):
+            return
+        word_filter = {
+            tag: str(word_filter[tag]) for tag in TAG_FIELDS if word_filter.get(tag)
+        }
+        try:
+            candidates = word_index.select(word_filter)
+        except Exception as e:
+            print(f"词库索引加载失败: {e}")
+            candidates = []
+        if candidates is not None and not len(candidates):
+            self.send_to(player_id, {"type": "error", "message": "没有符合条件的词条"})
+            return
+
+        self.word_filter = word_filter
+        self.publish(
+            [["filter", word_filter]], {"type": "word_filter", "filter": word_filter}
+        )
+
+    def is_alive(self, player_id):
+        info = self.player_info.get(player_id)
+        return info is not None and not info.get("eliminated", False)
+
+    def schedule_vote_progress(self):
+        if self.progress_timer is None:
+            self.progress_timer = self.server.call_later(
+                self.progress_interval, self.send_vote_progress
+            )
+
+    def cancel_vote_progress(self):
+        if self.progress_timer is not None:
+            self.progress_timer.cancel()
+            self.progress_timer = None
+
+    def send_vote_progress(self):
+        self.progress_timer = None
+        if self.game_state != GameState.VOTING:
+            return
+        counts, voted = self.tally.pairs(), len(self.tally)
+        self.publish(
+            [["tally", counts, voted]],
+            {
+                "type": "vote_progress",
+                "voted": voted,
+                "total": self.alive_count,
+                "counts": counts,
+            },
+        )
+
+    def finish_voting(self):
+        """所有存活玩家都已投票：由服务器决定结果，只广播一次"""
+        self.cancel_vote_progress()
+        leaders = self.tally.leaders()
+        # 平票时没有人被淘汰
+        eliminated_id = next(iter(leaders)) if len(leaders) == 1 else None
+        counts = self.tally.pairs()
+        self.tally.clear()
+
+        ops = [["clear_votes"]]
+        if eliminated_id is not None:
+            self.player_info[eliminated_id]["eliminated"] = True
+            self.alive_count -= 1
+            ops.insert(0, ["out", eliminated_id])
+        self.broadcast(
+            {"type": "vote_result", "eliminated": eliminated_id, "counts": counts}
+        )
+        self.publish(ops)
+
+        winner = None
+        if eliminated_id is not None:
+            if eliminated_id == self.undercover_id:
+                # 卧底被淘汰，平民胜利
+                winner = "平民"
+            elif self.alive_count <= 2 and self.is_alive(self.undercover_id):
+                # 存活玩家≤2且卧底仍在游戏中，卧底胜利
+                winner = "卧底"
+
+        if winner is not None:
+            # 广播游戏结果和所有玩家的词语
+            self.broadcast(
+                {
+                    "type": "game_over",
+                    "winner": winner,
+                    "undercover_id": self.undercover_id,
+                    "player_words": {
+                        pid: info.get("word", "")
+                        for pid, info in self.player_info.items()
+                    },
+                }
+            )
+            self.game_state = GameState.RESULT
+            self.publish([["phase", self.game_state.name]])
+        else:
+            # 游戏继续，存活的玩家重新描述两轮
+            self.game_state = GameState.PLAYING
+            self.turn_count = 0
+            self.current_turn = self.next_alive(self.current_turn)
+            self.publish(
+                [
+                    ["phase", self.game_state.name],
+                    ["turn", self.current_turn, self.turn_count],
+                ],
+                {
+                    "type": "next_turn",
+                    "current_turn": self.current_turn,
+                    "turn_count": self.turn_count,
+                },
+            )
+
+    def next_alive(self, index):
+        # 从 index 之后找到下一个未淘汰的玩家
+        player_ids = list(self.player_info.keys())
+        for step in range(1, len(player_ids) + 1):
+            candidate = (index + step) % len(player_ids)
+            if self.is_alive(player_ids[candidate]):
+                return candidate
+        return 0
+
+    def next_turn(self):
+        self.current_turn = self.next_alive(self.current_turn)
+        self.turn_count += 1
+        turn = ["turn", self.current_turn, self.turn_count]
+
+        # 如果存活的玩家都描述了两轮，进入投票阶段
+        if self.turn_count >= self.alive_count * 2:
+            self.game_state = GameState.VOTING
+            self.tally.clear()
+            self.publish(
+                [turn, ["phase", self.game_state.name]], {"type": "voting_start"}
+            )
+        else:
+            self.publish(
+                [turn],
+                {
+                    "type": "next_turn",
+                    "current_turn": self.current_turn,
+                    "turn_count": self.turn_count,
+                },
+            )
+
+    def reset_game(self):
+        """重置游戏状态，但不关闭服务器"""
+        self.game_state = GameState.LOBBY
+        self.current_turn = 0
+        self.turn_count = 0
+        self.cancel_vote_progress()
+        self.tally.clear()
+        self.undercover_id = None
+
+        # 重置所有玩家状态
+        for player_id in self.player_info:
+            self.player_info[player_id] = {
+                "name": self.player_info[player_id]["name"],
+                "is_host": self.player_info[player_id]["is_host"],
+                "eliminated": False,
+            }
+        self.alive_count = len(self.player_info)
+
+        # 广播游戏重置消息
+        self.publish(
+            [["reset"]],
+            {
+                "type": "game_reset",
+                "players": [
+                    {"id": p_id, "name": p_info["name"], "is_host": p_info["is_host"]}
+                    for p_id, p_info in self.player_info.items()
+                ],
+            },
+        )
+
+
+def create_listen_socket(host, port, backlog):
+    server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    try:
+        server_socket.bind((host, port))
+    except OSError as e:
+        if e.errno in (48, errno.EADDRINUSE):
+            print("端口已被占用")
+            server_socket.close()
+            return None
+        raise
+    server_socket.listen(backlog)
+    return server_socket
+
+
+# 分片模式下工作进程的上下文
+class ShardContext:
+    """
+    记录工作进程编号、共享的房间路由表，以及进程间转交连接用的 Unix 套接字。
+    channels 中第 i 对套接字由第 i 个工作进程接收
+    """
+
+    def __init__(self, index, count, routes, channels):
+        self.index = index
+        self.count = count
+        self.routes = routes  # {room_id: 房间摘要，其中 worker 为所在进程编号}
+        self.channels = channels
+
+    @property
+    def recv_socket(self):
+        return self.channels[self.index][1]
+
+    def owner(self, room_id):
+        route = self.routes.get(room_id)
+        if route is None:
+            # 默认房间固定由 0 号进程负责
+            return 0 if room_id == GameServer.DEFAULT_ROOM_ID else None
+        return route["worker"]
+
+    def publish(self, room):
+        self.routes[room.id] = dict(room.summary(), worker=self.index)
+
+    def unpublish(self, room_id):
+        self.routes.pop(room_id, None)
+
+    def hand_off(self, worker, sock, pending):
+        # 把套接字和已经读到但未处理的数据一起交给目标进程
+        socket.send_fds(self.channels[worker][0], [pending], [sock.fileno()])
+
+    def receive(self):
+        pending, fds, _, _ = socket.recv_fds(self.recv_socket, 1 << 17, 1)
+        return socket.socket(fileno=fds[0]), pending
+
+
+# 慢客户端处理策略：丢弃聊天、合并状态消息、直接断开
+SLOW_CONSUMER_POLICIES = ("drop_chat", "coalesce", "disconnect")
+
+# 可合并的状态消息：{消息类型: 区分同类消息的字段}，队列中只保留最新的一条
+COALESCE_FIELDS = {"next_turn": None, "vote_progress": None}
+# 增量同步的状态消息共用一个合并键：拥塞时队列里的增量和快照全部丢弃，
+# 换成一份最新快照，因为丢掉任何一条增量后面的增量都接不上了
+STATE_SYNC_KEY = ("state", None)
+STATE_SYNC_TYPES = ("state_delta", "state_snapshot")
+
+
+class Backpressure:
+    """发送缓冲区的高低水位线和超过高水位后的处理策略"""
+
+    def __init__(self, policy="drop_chat", high_water=256 * 1024, low_water=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"未知的慢客户端策略: {policy}")
+        self.policy = policy
+        self.high_water = high_water
+        self.low_water = high_water // 4 if low_water is None else low_water
+        # 无论哪种策略，积压超过这个值都断开，保证内存有上限
+        self.hard_limit = high_water * 4
+        self.lock = threading.Lock()  # 线程模式下多个连接同时计数
+        self.counts = dict.fromkeys(SLOW_CONSUMER_POLICIES, 0)
+
+    def count(self, policy):
+        with self.lock:
+            self.counts[policy] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class WriteBatching:
+    """
+    写出批处理：window 秒内发给同一连接的消息合并成一次写入（0 表示立即写出），
+    nodelay 控制 TCP_NODELAY（None 表示保持系统默认），并统计合并效果
+    """
+
+    def __init__(self, window=0.0, nodelay=None):
+        self.window = window
+        self.nodelay = nodelay
+        self.lock = threading.Lock()  # 线程模式下多个写线程同时计数
+        self.writes = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def configure(self, sock):
+        if self.nodelay is not None and sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, self.nodelay)
+            except OSError:
+                pass
+
+    def record(self, messages, size):
+        with self.lock:
+            self.writes += 1
+            self.messages += messages
+            self.bytes += size
+
+    def stats(self):
+        with self.lock:
+            writes, messages, size = self.writes, self.messages, self.bytes
+        return {
+            "writes": writes,
+            "messages": messages,
+            "bytes": size,
+            "messages_per_write": messages / writes if writes else 0.0,
+            "syscalls_saved": messages - writes,
+        }
+
+
+# 耗时直方图的桶上界（秒），最后还有一个 +Inf 桶
+LATENCY_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+)
+
+
+class Histogram:
+    __slots__ = ("buckets", "total", "count")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def to_dict(self):
+        cumulative, running = [], 0
+        for count in self.buckets:
+            running += count
+            cumulative.append(running)
+        return {"buckets": cumulative, "sum": self.total, "count": self.count}
+
+
+def label_value(value):
+    # Prometheus 标签值需要转义反斜杠、双引号和换行
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def metric_type(msg_type):
+    # 客户端可以发送任意类型名，不认识的都归到 unknown，避免指标无限增长
+    if isinstance(msg_type, str) and msg_type in MESSAGE_TYPE_CODES:
+        return msg_type
+    return "unknown"
+
+
+class ServerMetrics:
+    """
+    服务器运行指标：按消息类型统计收发条数、处理耗时直方图，以及广播耗时。
+    连接数、房间数、发送队列深度在读取时从服务器现场计算
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()  # 线程模式下多个读线程同时计数
+        self.started = time.time()
+        self.messages_in = {}  # {消息类型: 条数}
+        self.messages_out = {}  # {消息类型: 条数（按接收者计）}
+        self.bytes_in = 0
+        self.handlers = {}  # {消息类型: Histogram}
+        self.broadcasts = Histogram()
+        self.fanout = 0  # 广播的接收者总数
+
+    def received(self, msg_type, size, seconds):
+        msg_type = metric_type(msg_type)
+        with self.lock:
+            self.messages_in[msg_type] = self.messages_in.get(msg_type, 0) + 1
+            self.bytes_in += size
+            histogram = self.handlers.get(msg_type)
+            if histogram is None:
+                histogram = self.handlers[msg_type] = Histogram()
+            histogram.observe(seconds)
+
+    def sent(self, msg_type, recipients, seconds=None):
+        msg_type = metric_type(msg_type)
+        with self.lock:
+            self.messages_out[msg_type] = (
+                self.messages_out.get(msg_type, 0) + recipients
+            )
+            if seconds is not None:
+                self.broadcasts.observe(seconds)
+                self.fanout += recipients
+
+    def snapshot(self):
+        server = self.server
+        connections = list(server.clients.values())
+        queued = [c.buffered_bytes() for c in connections]
+        with self.lock:
+            data = {
+                "uptime": time.time() - self.started,
+                "clients": len(connections),
+                "rooms": len(server.rooms),
+                "players": len(server.player_rooms),
+                "messages_in": dict(self.messages_in),
+                "messages_out": dict(self.messages_out),
+                "bytes_in": self.bytes_in,
+                "handler_seconds": {t: h.to_dict() for t, h in self.handlers.items()},
+                "broadcast_seconds": self.broadcasts.to_dict(),
+                "broadcast_recipients": self.fanout,
+            }
+        data["writes"] = server.batching.stats()
+        data["bytes_out"] = data["writes"]["bytes"]
+        data["slow_consumers"] = server.backpressure.stats()
+        data["queue_bytes"] = {
+            "total": sum(queued),
+            "max": max(queued, default=0),
+            "messages": sum(len(c.queue) for c in connections),
+        }
+        return data
+
+    def render(self):
+        """Prometheus 文本格式"""
+        data = self.snapshot()
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE undercover_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"undercover_{name}{labels} {value}")
+
+        def histogram(name, label, histograms):
+            lines.append(f"# TYPE undercover_{name} histogram")
+            bounds = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+            for key, h in histograms:
+                prefix = f'{label}="{label_value(key)}",' if label else ""
+                for bound, count in zip(bounds, h["buckets"]):
+                    lines.append(
+                        f'undercover_{name}_bucket{{{prefix}le="{bound}"}} {count}'
+                    )
+                tags = f"{{{prefix[:-1]}}}" if prefix else ""
+                lines.append(f"undercover_{name}_sum{tags} {h['sum']}")
+                lines.append(f"undercover_{name}_count{tags} {h['count']}")
+
+        for name in ("clients", "rooms", "players"):
+            metric(name, "gauge", [("", data[name])])
+        metric(
+            "queue_bytes",
+            "gauge",
+            [('{stat="total"}', data["queue_bytes"]["total"])]
+            + [('{stat="max"}', data["queue_bytes"]["max"])],
+        )
+        metric("queue_messages", "gauge", [("", data["queue_bytes"]["messages"])])
+        for direction in ("in", "out"):
+            metric(
+                f"messages_{direction}_total",
+                "counter",
+                [
+                    (f'{{type="{label_value(t)}"}}', n)
+                    for t, n in data[f"messages_{direction}"].items()
+                ],
+            )
+            metric(
+                f"bytes_{direction}_total",
+                "counter",
+                [("", data[f"bytes_{direction}"])],
+            )
+        metric("writes_total", "counter", [("", data["writes"]["writes"])])
+        metric(
+            "slow_consumers_total",
+            "counter",
+            [
+                (f'{{policy="{label_value(p)}"}}', n)
+                for p, n in data["slow_consumers"].items()
+            ],
+        )
+        histogram("handler_seconds", "type", data["handler_seconds"].items())
+        histogram("broadcast_seconds", None, [(None, data["broadcast_seconds"])])
+        metric(
+            "broadcast_recipients_total",
+            "counter",
+            [("", data["broadcast_recipients"])],
+        )
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # /metrics 返回 Prometheus 文本格式，/metrics.json 返回 JSON
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path == "/metrics":
+            body = metrics.render().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求很频繁，不打印访问日志
+        pass
+
+
+class Session:
+    """可恢复的玩家会话，记录最近发给该玩家的消息，断线重连后补发"""
+
+    def __init__(self, token, player_id, connection, size):
+        self.token = token
+        self.player_id = player_id
+        self.protocol = connection.protocol
+        self.features = connection.features
+        self.frames = deque(maxlen=size)
+        self.sent = 0  # 已记录的消息总数，也就是下一条消息的序号
+        self.lock = threading.RLock()
+        self.timer = None  # 断线后的过期计时器
+        self.owner = connection  # 当前绑定的连接
+
+    def record(self, frame, connection=None):
+        with self.lock:
+            # 已被取代的连接写出的数据不计入，客户端不会再从那个连接读取
+            if connection is None or connection is self.owner:
+                self.frames.append(frame)
+                self.sent += 1
+
+    def missed(self, received):
+        """客户端还没收到的消息；缓冲区里已经找不全时返回 None"""
+        missing = self.sent - received
+        if missing < 0 or missing > len(self.frames):
+            return None
+        return list(self.frames)[len(self.frames) - missing :]
+
+
+# 待发送的消息：每种协议只编码一次，广播时所有连接共享同一份不可变的字节
+class OutboundMessage:
+    __slots__ = ("data", "frames", "droppable", "coalesce_key", "resync")
+
+    def __init__(self, data, droppable=False, resync=None):
+        self.data = data
+        self.frames = {}
+        self.droppable = droppable  # 拥塞时可以丢弃，例如聊天
+        # 状态增量接不上时返回代替它的快照消息
+        self.resync = resync
+
+        msg_type = data.get("type")
+        self.coalesce_key = None
+        if msg_type in STATE_SYNC_TYPES:
+            self.coalesce_key = STATE_SYNC_KEY
+        elif msg_type in COALESCE_FIELDS:
+            field = COALESCE_FIELDS[msg_type]
+            self.coalesce_key = (msg_type, data.get(field) if field else None)
+
+    def frame(self, protocol):
+        frame = self.frames.get(protocol)
+        if frame is None:
+            frame = self.frames[protocol] = encode_message(self.data, protocol)
+        return frame
+
+
+# 服务器端的客户端连接，每个连接有自己的发送队列
+class ClientConnection(ABC):
+    def __init__(self, ip, backpressure, batching):
+        self.ip = ip
+        self.protocol = PROTOCOL_JSON  # 加入时协商
+        self.features = set()
+        self.closed = False
+        self.backpressure = backpressure
+        self.batching = batching
+        self.congested = False
+        self.queue = deque()  # [(合并键, 帧, 会话)]
+        self.queued_bytes = 0
+        self.session = None  # 写出的消息记录到这个会话，用于断线重连
+
+    @abstractmethod
+    def send(self, message):
+        """把一条 OutboundMessage 放入发送队列，子类决定何时写出"""
+
+    def buffered_bytes(self):
+        return self.queued_bytes
+
+    def admit(self, message):
+        """
+        检查发送缓冲区水位，拥塞时按策略处理这条消息。
+        返回要入队的消息（合并状态时可能换成最新快照）；
+        返回 False 表示消息已被丢弃或合并，不需要再入队；
+        返回 None 表示积压过多，调用方应在释放连接的锁之后断开连接
+        """
+        backpressure = self.backpressure
+        buffered = self.buffered_bytes()
+        if self.congested:
+            # 回落到低水位以下才解除拥塞，避免在高水位附近反复切换
+            self.congested = buffered > backpressure.low_water
+        else:
+            self.congested = buffered >= backpressure.high_water
+        if not self.congested:
+            return message
+
+        policy = backpressure.policy
+        if policy == "disconnect" or buffered >= backpressure.hard_limit:
+            backpressure.count("disconnect")
+            print(f"客户端 {self.ip} 积压 {buffered} 字节，断开连接")
+            return None
+        if policy == "drop_chat" and message.droppable:
+            backpressure.count("drop_chat")
+            return False
+        if policy == "coalesce" and message.coalesce_key == STATE_SYNC_KEY:
+            if self.discard_queued(STATE_SYNC_KEY, every=True):
+                backpressure.count("coalesce")
+                if message.resync is not None:
+                    # 排队的增量已丢弃，这条增量也接不上了，改发最新快照
+                    message = message.resync()
+        elif policy == "coalesce" and message.coalesce_key is not None:
+            if self.discard_queued(message.coalesce_key):
+                backpressure.count("coalesce")
+        return message
+
+    def push(self, message):
+        frame = message.frame(self.protocol)
+        self.queue.append((message.coalesce_key, frame, self.session))
+        self.queued_bytes += len(frame)
+
+    def replay(self, frames):
+        # 补发的消息在会话中已有序号，不再重复记录
+        for frame in frames:
+            self.queue.append((None, frame, None))
+            self.queued_bytes += len(frame)
+
+    def wrote(self, frame, session):
+        if session is not None:
+            session.record(frame, self)
+
+    def lost(self, message):
+        # 连接已关闭但还没被服务器移除时发来的消息，和断线期间一样记入会话
+        if self.session is not None:
+            self.session.record(message.frame(self.session.protocol), self)
+
+    def take_queue(self):
+        entries = list(self.queue)
+        self.queue.clear()
+        self.queued_bytes = 0
+        return entries
+
+    def release(self, entries):
+        # 连接关闭时还没写出的消息记入会话，重连后补发
+        for _, frame, session in entries:
+            self.wrote(frame, session)
+
+    def discard_queued(self, key, every=False):
+        """
+        删除队列中尚未发送的同类旧消息，新消息追加到队尾，保证先后顺序。
+        every 为 True 时删除所有同类消息，返回是否删除了消息
+        """
+        if not every:
+            for i, (queued_key, frame, _) in enumerate(self.queue):
+                if queued_key == key:
+                    del self.queue[i]
+                    self.queued_bytes -= len(frame)
+                    return True
+            return False
+        kept = deque()
+        for entry in self.queue:
+            if entry[0] == key:
+                self.queued_bytes -= len(entry[1])
+            else:
+                kept.append(entry)
+        discarded = len(kept) != len(self.queue)
+        self.queue = kept
+        return discarded
+
+    def flush(self):
+        pass
+
+    def wait_closed(self, timeout=1.0):
+        # 等待已关闭的连接把手上的消息全部记入会话
+        pass
+
+    def abort(self):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.release(self.take_queue())
+
+
+class ThreadedConnection(ClientConnection):
+    """阻塞套接字连接，发送队列由该连接专用的写线程清空"""
+
+    def __init__(self, sock, ip, backpressure, batching):
+        super().__init__(ip, backpressure, batching)
+        self.sock = sock
+        batching.configure(sock)
+        self.in_flight = 0  # 写线程正在发送的字节数
+        # 写线程在世时由它按顺序把写出和没写出的消息记入会话，退出后才由 send 直接记入
+        self.writer_done = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def buffered_bytes(self):
+        return self.queued_bytes + self.in_flight
+
+    def send(self, message):
+        aborting = lost = False
+        with self.condition:
+            if not self.closed:
+                admitted = self.admit(message)
+                if admitted:
+                    self.push(admitted)
+                    self.condition.notify()
+                    return
+                if admitted is False:
+                    # 按策略丢弃或合并
+                    return
+                # 积压过多，断开连接；这条消息和队列里的消息一起记入会话
+                self.closed = aborting = True
+                self.condition.notify_all()
+            if self.writer_done:
+                lost = True
+            else:
+                # 写线程退出时会把它正在发送的一批和队列依次记入会话
+                self.push(message)
+        # 记入会话要取会话锁，必须在释放连接的锁之后进行：
+        # 恢复会话时是先持有会话锁再操作连接
+        if aborting:
+            self.abort()
+        if lost:
+            self.lost(message)
+
+    def replay(self, frames):
+        with self.condition:
+            super().replay(frames)
+            self.condition.notify()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    break
+                if self.batching.window:
+                    # 等待一个时间窗，窗口内到达的消息一次写出；
+                    # 等待期间队列里的消息仍然可以被合并或丢弃
+                    self.condition.wait_for(lambda: self.closed, self.batching.window)
+                    if self.closed:
+                        break
+                    entries = self.take_queue()
+                else:
+                    # 每次只取一帧，留在队列里的消息仍然可以被合并
+                    entries = [self.queue.popleft()]
+                    self.queued_bytes -= len(entries[0][1])
+                frames = [frame for _, frame, _ in entries]
+                data = frames[0] if len(frames) == 1 else b"".join(frames)
+                self.in_flight = len(data)
+
+            try:
+                self.write_all(data)
+                self.batching.record(len(frames), len(data))
+                for _, frame, session in entries:
+                    self.wrote(frame, session)
+            except OSError as e:
+                if not self.closed:
+                    print(f"发送失败: {e}")
+                # 没有写完的这一批也算没发出去
+                self.finish(entries)
+                return
+
+            with self.condition:
+                self.in_flight = 0
+                self.condition.notify_all()
+        self.finish()
+
+    def finish(self, entries=()):
+        """写线程退出：把没写出的消息按顺序记入会话，之后由 send 直接记入"""
+        session = self.session
+        # 先取会话锁再取连接的锁，与恢复会话的顺序一致；
+        # 持有会话锁期间，其他线程直接记入会话的消息只能排在这些消息之后
+        with session.lock if session is not None else contextlib.nullcontext():
+            with self.condition:
+                self.closed = True
+                self.writer_done = True
+                leftover = self.take_queue()
+                self.in_flight = 0
+                self.condition.notify_all()
+            self.release(list(entries) + leftover)
+
+    def write_all(self, data):
+        # send 可能只写出一部分，剩下的继续发送
+        view = memoryview(data)
+        while view:
+            sent = self.sock.send(view)
+            view = view[sent:]
+
+    def flush(self, timeout=1.0):
+        # 等待队列中的数据全部写出
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.closed or not (self.queue or self.in_flight), timeout
+            )
+
+    def wait_closed(self, timeout=1.0):
+        # 写线程退出前会把正在发送的这一批和队列里剩下的消息记入会话
+        if threading.current_thread() is not self.writer:
+            self.writer.join(timeout)
+
+    def abort(self):
+        # 关闭读写两端：阻塞在 send 的写线程和读线程都会立即返回
+        self.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        # 队列里的消息由写线程退出时记入会话
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class AsyncConnection(ClientConnection):
+    """asyncio 连接，发送队列在事件循环的下一轮一次性写入传输层"""
+
+    def __init__(self, transport, ip, loop, backpressure, batching):
+        super().__init__(ip, backpressure, batching)
+        self.transport = transport
+        self.loop = loop
+        self.scheduled = False
+        self.paused = False  # 传输层缓冲区超过高水位
+        transport.set_write_buffer_limits(
+            backpressure.high_water, backpressure.low_water
+        )
+        batching.configure(transport.get_extra_info("socket"))
+
+    def buffered_bytes(self):
+        return self.queued_bytes + self.transport.get_write_buffer_size()
+
+    def send(self, message):
+        if self.closed:
+            self.lost(message)
+            return
+        admitted = self.admit(message)
+        if admitted is None:
+            # 队列先记入会话，这条消息排在最后
+            self.abort()
+            self.lost(message)
+        elif admitted:
+            self.push(admitted)
+            self.schedule_flush()
+
+    def replay(self, frames):
+        super().replay(frames)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if not self.scheduled:
+            self.scheduled = True
+            if self.batching.window:
+                # 时间窗内的消息攒在队列里，到期后一次写入
+                self.loop.call_later(self.batching.window, self.flush)
+            else:
+                self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        # 传输层暂停写入时消息留在自己的队列里，还能被合并或丢弃
+        if self.paused or self.closed or self.transport.is_closing():
+            return
+        if self.queue:
+            # 传输层负责处理部分写入
+            frames = [frame for _, frame, _ in self.queue]
+            self.transport.writelines(frames)
+            self.batching.record(len(frames), self.queued_bytes)
+            for _, frame, session in self.queue:
+                self.wrote(frame, session)
+            self.queue.clear()
+            self.queued_bytes = 0
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def abort(self):
+        self.close()
+        self.transport.abort()
+
+    def close(self):
+        self.closed = True
+        self.release(self.take_queue())
+
+
+# 游戏服务器类
+class GameServer:
+    backlog = 5
+    read_size = 16 * 1024
+    max_frame_size = 64 * 1024  # 单条消息的最大长度，防止恶意客户端撑爆内存
+    session_grace = 30  # 断线后保留座位的秒数
+    session_buffer = 512  # 每个会话保留的最近消息条数
+    DEFAULT_ROOM_ID = "default"
+
+    def __init__(
+        self, host="::", port=12345, shard=None, backpressure=None, batching=None
+    ):
+        self.host = host
+        self.port = port
+        self.server_socket = None
+        self.clients = {}
+        self.backpressure = backpressure or Backpressure()
+        self.batching = batching or WriteBatching()
+        self.metrics = None  # 调用 serve_metrics 后才统计
+        self.next_id = 1
+        self.running = False
+        # 线程模式下每个客户端一个处理线程，再加上计时器线程，
+        # 房间和会话状态的所有修改都在这把锁内串行执行
+        self.lock = threading.RLock()
+
+        # 房间管理
+        self.rooms = {}  # {room_id: Room}
+        self.player_rooms = {}  # {player_id: room_id}
+        self.next_room_id = 1
+        self.rooms[self.DEFAULT_ROOM_ID] = Room(self, self.DEFAULT_ROOM_ID, "默认房间")
+
+        # 分片模式：shard 为 None 时是普通的单进程服务器
+        self.shard = shard
+        self.handoffs = {}  # {player_id: 目标工作进程}，等待转交的连接
+
+        # 断线重连
+        self.sessions = {}  # {token: Session}
+        self.player_sessions = {}  # {player_id: Session}
+        self.rebound = {}  # {新连接的临时ID: 恢复的玩家ID}，由读取循环取走
+
+    def bind(self):
+        self.server_socket = create_listen_socket(self.host, self.port, self.backlog)
+        return self.server_socket is not None
+
+    def start(self):
+        # 分片模式下监听套接字由主进程创建后传入
+        if self.server_socket is None and not self.bind():
+            return
+        self.running = True
+        print(f"服务器启动: {self.host}:{self.port}")
+
+        self.accept_thread = threading.Thread(target=self.accept_clients)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+
+        if self.shard is not None:
+            self.publish_default_room()
+            thread = threading.Thread(target=self.receive_handoffs)
+            thread.daemon = True
+            thread.start()
+
+    def serve_metrics(self, host="127.0.0.1", port=9100):
+        """开始统计运行指标，并在本机 HTTP 端口上提供给抓取程序"""
+        self.metrics = ServerMetrics(self)
+        try:
+            httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            print(f"指标端口 {port} 监听失败: {e}")
+            return None
+        httpd.daemon_threads = True
+        httpd.metrics = self.metrics
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print(f"运行指标: http://{host}:{port}/metrics")
+        return httpd
+
+    def receive(self, player_id, frame):
+        """处理客户端发来的一帧"""
+        message = decode_frame(frame)
+        if message is None:
+            return
+        if self.metrics is None:
+            self.handle_message(player_id, message)
+            return
+        started = time.perf_counter()
+        try:
+            self.handle_message(player_id, message)
+        finally:
+            self.metrics.received(
+                str(message.get("type")), len(frame), time.perf_counter() - started
+            )
+
+    def serve_forever(self):
+        # 独立运行服务器时使用，阻塞直到服务器停止
+        self.start()
+        if self.running:
+            self.accept_thread.join()
+
+    def new_player_id(self):
+        player_id = self.next_id
+        self.next_id += 1
+        if self.shard is not None:
+            # 各工作进程分配的玩家ID互不重叠
+            player_id = player_id * self.shard.count + self.shard.index
+        return player_id
+
+    def accept_clients(self):
+        while self.running:
+            conn, ip = self.server_socket.accept()
+            with self.lock:
+                player_id = self.new_player_id()
+                self.clients[player_id] = ThreadedConnection(
+                    conn, ip, self.backpressure, self.batching
+                )
+
+            print(f"玩家 {player_id} 已连接: {ip}")
+            thread = threading.Thread(target=self.handle_client, args=(player_id, conn))
+            thread.daemon = True
+            thread.start()
+
+    def receive_handoffs(self):
+        # 接收其他工作进程转交过来的连接
+        while self.running:
+            conn, pending = self.shard.receive()
+            with self.lock:
+                player_id = self.new_player_id()
+                self.clients[player_id] = ThreadedConnection(
+                    conn, conn.getpeername(), self.backpressure, self.batching
+                )
+            thread = threading.Thread(
+                target=self.handle_client, args=(player_id, conn, pending)
+            )
+            thread.daemon = True
+            thread.start()
+
+    def hand_off(self, player_id, conn, pending):
+        with self.lock:
+            worker = self.handoffs.pop(player_id)
+            self.leave_room(player_id)
+            connection = self.clients.pop(player_id, None)
+        # 先把已经排队的消息发完，再交出套接字；等待写出时不持有服务器锁
+        if connection is not None:
+            connection.flush()
+            connection.close()
+        self.shard.hand_off(worker, conn, pending)
+
+    def handle_client(self, player_id, conn, pending=b""):
+        connection = self.clients.get(player_id)
+        reader = FrameReader(self.read_size, self.max_frame_size)
+        reader.feed(pending)
+        while self.running:
+            try:
+                frames = reader.read_frames()
+                for i, frame in enumerate(frames):
+                    with self.lock:
+                        try:
+                            self.receive(player_id, frame)
+                        except ValueError as e:
+                            print(f"消息解析错误: {e}")
+                        # 恢复会话后这个连接改用原来的玩家ID
+                        player_id = self.rebound.pop(player_id, player_id)
+                        handed_off = player_id in self.handoffs
+
+                    if handed_off:
+                        # 房间在其他工作进程，连同未处理的数据一起转交
+                        pending = b"".join(frames[i:]) + reader.pending()
+                        self.hand_off(player_id, conn, pending)
+                        conn.close()
+                        return
+
+                if not reader.recv_from(conn):
+                    break
+            except Exception as e:
+                print(f"客户端错误: {e}")
+                break
+
+        # 客户端断开连接的处理
+        print(f"玩家 {player_id} 断开连接")
+        with self.lock:
+            self.handle_disconnect(player_id, connection)
+        conn.close()
+
+    def handle_disconnect(self, player_id, connection=None):
+        current = self.clients.get(player_id)
+        if connection is not None and current is not connection:
+            # 这个连接已经被恢复的会话取代
+            connection.close()
+            return
+
+        # 从客户端列表中移除（连接已关闭，不再向它广播）
+        self.clients.pop(player_id, None)
+        if current is not None:
+            # 等写线程把剩下的消息记入会话，之后的消息由 deliver 直接记入，顺序不乱
+            current.abort()
+            current.wait_closed()
+
+        session = self.player_sessions.get(player_id)
+        if session is not None and self.running:
+            # 暂时保留座位，等待客户端带着会话令牌重连
+            session.timer = self.call_later(
+                self.session_grace, self.expire_session, session
+            )
+            return
+
+        self.leave_room(player_id)
+
+    def call_later(self, delay, callback, *args):
+        timer = threading.Timer(delay, self.locked, (callback,) + args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def locked(self, callback, *args):
+        # 计时器线程和客户端处理线程一样，在服务器锁内修改状态
+        with self.lock:
+            callback(*args)
+
+    def open_session(self, player_id):
+        """加入房间时创建新会话，返回令牌"""
+        connection = self.clients.get(player_id)
+        if connection is None:
+            return None
+        self.drop_session(player_id)
+        token = secrets.token_hex(16)
+        if self.shard is not None:
+            # 令牌带上工作进程编号，重连到其他进程时可以转交
+            token = f"{self.shard.index}-{token}"
+        session = Session(token, player_id, connection, self.session_buffer)
+        self.sessions[token] = session
+        self.player_sessions[player_id] = session
+        connection.session = session
+        return token
+
+    def drop_session(self, player_id):
+        session = self.player_sessions.pop(player_id, None)
+        if session is not None:
+            self.sessions.pop(session.token, None)
+            if session.timer is not None:
+                session.timer.cancel()
+
+    def expire_session(self, session):
+        # 宽限期内没有重连，玩家正式离开
+        if self.player_sessions.get(session.player_id) is not session:
+            return
+        if session.player_id in self.clients:
+            return
+        print(f"玩家 {session.player_id} 的会话已过期")
+        self.leave_room(session.player_id)
+
+    def resume_session(self, player_id, token, received):
+        connection = self.clients.get(player_id)
+        session = self.sessions.get(token)
+        if connection is None or session is None:
+            self.send_to(player_id, {"type": "resume_failed"})
+            return
+
+        previous = session.owner
+        if previous is not None:
+            # 服务器可能还没发现旧连接已断开，直接取代它。
+            # 断开和等待都在会话锁之外：旧连接的写线程记入会话时要取会话锁，
+            # 等它退出后，旧连接写出或没写出的消息都已经计入 session.sent
+            previous.abort()
+            previous.wait_closed()
+
+        with session.lock:
+            session.owner = None
+            frames = session.missed(received)
+            if frames is None:
+                # 错过的消息太多，只能重新加入
+                self.send_to(player_id, {"type": "resume_failed"})
+                self.leave_room(session.player_id)
+                return
+
+            if session.timer is not None:
+                session.timer.cancel()
+                session.timer = None
+            del self.clients[player_id]
+            connection.protocol = session.protocol
+            connection.features = session.features
+            connection.replay(frames)
+            connection.session = session
+            session.owner = connection
+            self.clients[session.player_id] = connection
+            self.rebound[player_id] = session.player_id
+
+        print(f"玩家 {session.player_id} 恢复会话，补发 {len(frames)} 条消息")
+        self.send_to(session.player_id, {"type": "resumed"})
+
+    def create_room(self, name=""):
+        room_id = str(self.next_room_id)
+        self.next_room_id += 1
+        if self.shard is not None:
+            room_id = f"{self.shard.index}-{room_id}"
+        room = Room(self, room_id, name or f"房间 {room_id}")
+        self.rooms[room_id] = room
+        self.room_changed(room)
+        return room
+
+    def publish_default_room(self):
+        # 默认房间只在 0 号进程中登记，其他进程把加入请求转交过去
+        if self.shard.index == 0:
+            self.room_changed(self.rooms[self.DEFAULT_ROOM_ID])
+
+    def room_changed(self, room):
+        # 房间人数变化时更新路由表中的摘要
+        if self.shard is not None:
+            self.shard.publish(room)
+
+    def get_room(self, player_id):
+        room_id = self.player_rooms.get(player_id)
+        return self.rooms.get(room_id) if room_id is not None else None
+
+    def leave_room(self, player_id):
+        self.drop_session(player_id)
+        room = self.get_room(player_id)
+        self.player_rooms.pop(player_id, None)
+        if room is None:
+            return
+
+        room.remove_player(player_id)
+        # 空房间直接回收（默认房间保留）
+        if not room.player_info and room.id != self.DEFAULT_ROOM_ID:
+            self.rooms.pop(room.id, None)
+            if self.shard is not None:
+                self.shard.unpublish(room.id)
+
+    def handle_message(self, player_id, message):
+        msg_type = message.get("type")
+
+        if msg_type == "ping":
+            # 原样带回客户端的时间戳，客户端据此计算往返时间
+            self.send_to(player_id, {"type": "pong", "time": message.get("time")})
 
-            # 保存玩家信息
-            self.player_info[player_id] = {"name": name, "is_host": is_host}
+        elif msg_type == "list_rooms":
+            if self.shard is not None:
+                # 分片模式下从共享路由表读取所有进程的房间
+                rooms = [
+                    {k: v for k, v in route.items() if k != "worker"}
+                    for route in self.shard.routes.values()
+                ]
+            else:
+                rooms = [room.summary() for room in self.rooms.values()]
+            self.send_to(player_id, {"type": "room_list", "rooms": rooms})
 
-            # 给新玩家发送已有玩家列表
-            existing_players = []
-            for pid, info in self.player_info.items():
-                if pid != player_id:
-                    existing_players.append(
-                        {"id": pid, "name": info["name"], "is_host": info["is_host"]}
-                    )
+        elif msg_type == "list_word_tags":
+            try:
+                tags = word_index.tags()
+            except Exception as e:
+                print(f"词库索引加载失败: {e}")
+                tags = {}
+            self.send_to(player_id, {"type": "word_tags", "tags": tags})
 
+        elif msg_type == "create_room":
+            room = self.create_room(message.get("name", ""))
             self.send_to(
                 player_id,
-                {
-                    "type": "player_list",
-                    "players": existing_players,
-                    "your_id": player_id,
-                    "is_host": is_host,  # 告诉客户端它的主机状态
-                },
-            )
-
-            # 广播新玩家加入
-            self.broadcast(
-                {
-                    "type": "player_joined",
-                    "id": player_id,
-                    "name": name,
-                    "is_host": is_host,
-                }
+                {"type": "room_created", "room_id": room.id, "name": room.name},
             )
 
-        elif msg_type == "start_game":
-            # 只有主机可以开始游戏
-            if not self.player_info[player_id]["is_host"]:
+        elif msg_type in ("join", "join_room"):
+            # 旧客户端不带房间号，进入默认房间
+            room_id = str(message.get("room_id", self.DEFAULT_ROOM_ID))
+            if self.shard is not None:
+                owner = self.shard.owner(room_id)
+                if owner is not None and owner != self.shard.index:
+                    # 由读取循环把连接转交给房间所在的进程，由它处理这条消息
+                    self.handoffs[player_id] = owner
+                    return
+
+            room = self.rooms.get(room_id)
+            if room is None:
+                self.send_to(player_id, {"type": "error", "message": "房间不存在"})
                 return
 
-            self.game_state = GameState.PLAYING
+            # 换房间时先离开原来的房间
+            if self.player_rooms.get(player_id) not in (None, room_id):
+                self.leave_room(player_id)
+
+            # 客户端声明支持二进制协议时，之后发给它的消息都使用二进制帧
+            connection = self.clients.get(player_id)
+            if connection and PROTOCOL_BINARY in message.get("protocols", ()):
+                connection.protocol = PROTOCOL_BINARY
+            if connection:
+                connection.features = set(message.get("features", ())).intersection(
+                    SUPPORTED_FEATURES
+                )
 
-            # 获取所有玩家ID
-            player_ids = list(self.player_info.keys())
-            if not player_ids:
-                return
+            self.player_rooms[player_id] = room_id
+            room.add_player(player_id, message["name"], message.get("is_host", False))
 
-            # 随机选择卧底
-            self.undercover_id = random.choice(player_ids)  # 保存卧底ID
-            word_pair = random.choice(word_pairs)
+        elif msg_type == "resume":
+            token = str(message.get("session", ""))
+            if self.shard is not None:
+                worker, _, _ = token.partition("-")
+                if worker.isdigit() and int(worker) != self.shard.index:
+                    # 会话在其他工作进程，把连接转交过去
+                    if int(worker) < self.shard.count:
+                        self.handoffs[player_id] = int(worker)
+                        return
+            self.resume_session(player_id, token, int(message.get("received", 0)))
 
-            # 分配词语并通知所有玩家
-            for pid in player_ids:
-                is_undercover = pid == self.undercover_id  # 使用保存的卧底ID
-                word = word_pair[1] if is_undercover else word_pair[0]
+        else:
+            if msg_type == "quit":
+                # 主动退出，不保留座位
+                self.drop_session(player_id)
+            room = self.get_room(player_id)
+            if room is not None:
+                room.handle_message(player_id, message)
+
+    def get_protocol(self, player_id):
+        connection = self.clients.get(player_id)
+        return connection.protocol if connection is not None else PROTOCOL_JSON
+
+    def has_feature(self, player_id, feature):
+        connection = self.clients.get(player_id)
+        return connection is not None and feature in connection.features
+
+    def deliver(self, player_id, message):
+        connection = self.clients.get(player_id)
+        if connection is None:
+            session = self.player_sessions.get(player_id)
+            if session is None:
+                return
+            with session.lock:
+                connection = self.clients.get(player_id)
+                if connection is None:
+                    # 断线期间的消息先记下来，重连后补发
+                    session.record(message.frame(session.protocol))
+                    return
+        connection.send(message)
 
-                # 保存玩家的词语信息
-                self.player_info[pid]["word"] = word
-                self.player_info[pid]["is_undercover"] = is_undercover
+    def send_to(self, player_id, data):
+        self.deliver(player_id, OutboundMessage(data))
+        if self.metrics is not None:
+            self.metrics.sent(data.get("type"), 1)
+
+    def broadcast_to(self, player_ids, data, droppable=False, resync=None):
+        # 只编码一次，放入各个连接的发送队列，不在当前线程里等待网络
+        started = time.perf_counter()
+        message = OutboundMessage(data, droppable, resync)
+        for pid in player_ids:
+            self.deliver(pid, message)
+        if self.metrics is not None:
+            self.metrics.sent(
+                data.get("type"), len(player_ids), time.perf_counter() - started
+            )
 
-                msg = {
-                    "type": "game_start",
-                    "your_id": pid,
-                    "word": word,
-                    "is_undercover": is_undercover,
-                    "players": [
-                        {
-                            "id": p_id,
-                            "name": p_info["name"],
-                            "is_host": p_info["is_host"],
-                        }
-                        for p_id, p_info in self.player_info.items()
-                    ],
-                }
-                self.send_to(pid, msg)
 
-            # 设置第一个回合
-            self.current_turn = 0
-            self.turn_count = 0
-            self.broadcast({"type": "next_turn", "current_turn": self.current_turn})
+# asyncio 服务器中每个连接对应的协议对象
+class AsyncClientProtocol(asyncio.BufferedProtocol):
+    def __init__(self, server, pending=b""):
+        self.server = server
+        # 空闲连接不保留读缓冲区，大量空闲连接时内存占用可控
+        self.reader = FrameReader(server.read_size, server.max_frame_size, keep_size=0)
+        self.reader.feed(pending)
+        self.transport = None
+        self.connection = None
+        self.player_id = None
+        self.handed_off = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.player_id = self.server.new_player_id()
+        ip = transport.get_extra_info("peername")
+        self.connection = AsyncConnection(
+            transport,
+            ip,
+            self.server.loop,
+            self.server.backpressure,
+            self.server.batching,
+        )
+        self.server.clients[self.player_id] = self.connection
+        print(f"玩家 {self.player_id} 已连接: {ip}")
 
-        elif msg_type == "vote":
-            target_id = message["target_id"]
-            # 记录投票
-            self.votes[player_id] = target_id
+        # 转交过来的连接可能已经带着未处理的数据
+        self.process_frames()
 
-            # 广播投票
-            self.broadcast(
-                {"type": "vote", "voter_id": player_id, "target_id": target_id}
-            )
+    def get_buffer(self, sizehint):
+        # 事件循环直接把数据 recv_into 到分帧器的缓冲区
+        return self.reader.get_buffer()
 
-            # 检查是否所有玩家都已投票
-            active_players = [pid for pid in self.player_info.keys()]
-            if len(self.votes) >= len(active_players):
-                self.check_voting_result()
+    def buffer_updated(self, nbytes):
+        self.reader.advance(nbytes)
+        self.process_frames()
 
-        elif msg_type == "send_message":
-            # 检查是否是当前回合的玩家
-            player_ids = list(self.player_info.keys())
-            if player_ids[self.current_turn] != player_id:
+    def process_frames(self):
+        try:
+            frames = self.reader.read_frames()
+        except ValueError as e:
+            print(f"玩家 {self.player_id} 的数据无效，断开连接: {e}")
+            self.transport.close()
+            return
+
+        for i, frame in enumerate(frames):
+            try:
+                self.server.receive(self.player_id, frame)
+            except ValueError as e:
+                print(f"消息解析错误: {e}")
+            except Exception as e:
+                print(f"客户端错误: {e}")
+                self.transport.close()
+                return
+            # 恢复会话后这个连接改用原来的玩家ID
+            self.player_id = self.server.rebound.pop(self.player_id, self.player_id)
+
+            if self.player_id in self.server.handoffs:
+                # 房间在其他工作进程，连同未处理的数据一起转交
+                pending = b"".join(frames[i:]) + self.reader.pending()
+                self.handed_off = True
+                sock = self.transport.get_extra_info("socket")
+                self.server.hand_off(self.player_id, sock, pending)
+                self.transport.abort()
                 return
 
-            text = message["message"]
-            self.broadcast(
-                {"type": "new_message", "player_id": player_id, "message": text}
-            )
+    def pause_writing(self):
+        self.connection.pause_writing()
 
-            # 切换到下一个回合
-            self.next_turn()
+    def resume_writing(self):
+        self.connection.resume_writing()
 
-        elif msg_type == "chat_message":
-            text = message["message"]
-            # 广播聊天消息给所有玩家
-            self.broadcast(
-                {"type": "new_message", "player_id": player_id, "message": text}
-            )
+    def connection_lost(self, exc):
+        if self.handed_off:
+            return
+        if exc is not None:
+            print(f"客户端错误: {exc}")
+        print(f"玩家 {self.player_id} 断开连接")
+        self.server.handle_disconnect(self.player_id, self.connection)
 
-        elif msg_type == "quit":
-            # 正常退出，不需要额外处理，连接会在handle_client中关闭
-            pass
 
-        elif msg_type == "restart_game":
-            # 只有主机可以重新开始游戏
-            if not self.player_info[player_id]["is_host"]:
-                return
+# 基于 asyncio 的游戏服务器：所有连接共用一个事件循环，不再为每个客户端开线程
+class AsyncGameServer(GameServer):
+    backlog = 1024
 
-            # 重置游戏
-            self.reset_game()
+    def __init__(
+        self, host="::", port=12345, shard=None, backpressure=None, batching=None
+    ):
+        super().__init__(host, port, shard, backpressure, batching)
+        self.loop = None
 
-    def next_turn(self):
-        player_ids = list(self.player_info.keys())
-        self.current_turn = (self.current_turn + 1) % len(player_ids)
-        self.turn_count += 1
+    def start(self):
+        # 在后台线程中运行事件循环，供游戏窗口内的主机使用
+        if self.server_socket is None and not self.bind():
+            return
+        self.running = True
+        print(f"服务器启动(asyncio): {self.host}:{self.port}")
+
+        self.accept_thread = threading.Thread(target=asyncio.run, args=(self.serve(),))
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await self.loop.create_server(
+            lambda: AsyncClientProtocol(self),
+            sock=self.server_socket,
+            backlog=self.backlog,
+        )
+        if self.shard is not None:
+            self.publish_default_room()
+            self.loop.add_reader(self.shard.recv_socket, self.receive_handoff)
+        async with server:
+            await server.serve_forever()
+
+    def receive_handoff(self):
+        conn, pending = self.shard.receive()
+        conn.setblocking(False)
+        self.loop.create_task(
+            self.loop.connect_accepted_socket(
+                lambda: AsyncClientProtocol(self, pending), conn
+            )
+        )
 
-        # 如果已经进行了两轮，进入投票阶段
-        if self.turn_count >= len(player_ids) * 2:
-            self.game_state = GameState.VOTING
-            self.broadcast({"type": "voting_start"})
-        else:
-            self.broadcast({"type": "next_turn", "current_turn": self.current_turn})
+    def call_later(self, delay, callback, *args):
+        # 计时器回调也在事件循环线程中执行
+        return self.loop.call_later(delay, callback, *args)
 
-    def send_to(self, player_id, data):
+
+# 多进程分片服务器
+class ShardedGameServer:
+    """
+    预先 fork 多个工作进程，共享同一个监听套接字，每个进程运行一个
+    GameServer 并拥有一部分房间。加入其他进程的房间时，连接会通过
+    Unix 套接字转交给房间所在的进程，客户端无感知
+    """
+
+    def __init__(
+        self,
+        host="::",
+        port=12345,
+        workers=None,
+        mode="thread",
+        backpressure=None,
+        batching=None,
+        metrics_port=None,
+    ):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.mode = mode
+        self.backpressure = backpressure
+        self.batching = batching
+        self.metrics_port = metrics_port  # 每个工作进程使用 metrics_port + 编号
+        self.processes = []
+
+    def serve_forever(self):
+        server_class = SERVER_MODES[self.mode]
+        listener = create_listen_socket(self.host, self.port, server_class.backlog)
+        if listener is None:
+            return
+
+        ctx = multiprocessing.get_context("fork")
+        manager = ctx.Manager()
+        routes = manager.dict()
+        channels = [
+            socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for _ in range(self.workers)
+        ]
+        print(f"分片服务器启动: {self.host}:{self.port}, {self.workers} 个工作进程")
+
+        def spawn(index):
+            shard = ShardContext(index, self.workers, routes, channels)
+            process = ctx.Process(
+                target=run_shard_worker,
+                args=(
+                    self.mode,
+                    self.host,
+                    self.port,
+                    listener,
+                    shard,
+                    self.backpressure,
+                    self.batching,
+                    self.metrics_port,
+                ),
+                daemon=True,
+            )
+            process.start()
+            return process
+
+        self.processes = [spawn(i) for i in range(self.workers)]
         try:
-            conn, _ = self.clients[player_id]
-            # 在 JSON 消息末尾添加换行符作为分隔符
-            message = json.dumps(data) + "\n"
-            conn.send(message.encode())
-        except Exception as e:
-            print(f"发送失败: {e}")
+            while True:
+                time.sleep(1)
+                for i, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        # 工作进程退出后，它的房间随之失效
+                        print(f"工作进程 {i} 已退出，重新启动")
+                        for room_id, route in list(routes.items()):
+                            if route["worker"] == i:
+                                routes.pop(room_id, None)
+                        self.processes[i] = spawn(i)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in self.processes:
+                process.terminate()
+            manager.shutdown()
 
-    def broadcast(self, data):
-        for pid in list(self.clients.keys()):
-            self.send_to(pid, data)
 
-    def reset_game(self):
-        """重置游戏状态，但不关闭服务器"""
-        self.game_state = GameState.LOBBY
-        self.current_turn = 0
-        self.turn_count = 0
-        self.votes = {}
-        self.undercover_id = None
+def run_shard_worker(
+    mode,
+    host,
+    port,
+    listener,
+    shard,
+    backpressure=None,
+    batching=None,
+    metrics_port=None,
+):
+    server = create_server(mode, host, port, shard, backpressure, batching)
+    server.server_socket = listener
+    if metrics_port is not None:
+        server.serve_metrics(port=metrics_port + shard.index)
+    server.serve_forever()
 
-        # 重置所有玩家状态
-        for player_id in self.player_info:
-            self.player_info[player_id] = {
-                "name": self.player_info[player_id]["name"],
-                "is_host": self.player_info[player_id]["is_host"],
-                "eliminated": False,
-            }
 
-        # 广播游戏重置消息
-        self.broadcast(
-            {
-                "type": "game_reset",
-                "players": [
-                    {"id": p_id, "name": p_info["name"], "is_host": p_info["is_host"]}
-                    for p_id, p_info in self.player_info.items()
-                ],
-            }
-        )
+# 服务器模式
+SERVER_MODES = {"thread": GameServer, "asyncio": AsyncGameServer}
+
+
+def create_server(
+    mode, host="::", port=12345, shard=None, backpressure=None, batching=None
+):
+    return SERVER_MODES[mode](host, port, shard, backpressure, batching)
 
 
 # 网络客户端类
 class NetworkClient:
-    def __init__(self, _game):
-        self.selected_vote_target = None
-        self.has_voted = None
+    def __init__(self, _game, protocol=PROTOCOL_JSON):
         self.game = _game
         self.socket = None
         self.connected = False
         self.host = False
         self.server_address = None
+        self.protocol = PROTOCOL_JSON  # 加入时由服务器确定
+        self.preferred_protocol = protocol  # 加入时请求的协议
+        self.read_size = 64 * 1024
+        self.reader = None
+        # 接收线程只解码消息放入收件箱，由主线程每帧调用 apply_pending 统一应用；
+        # None 表示连接已断开
+        self.inbox = deque()
+        self.rtt = None  # 最近一次 ping 的往返时间（秒）
+
+        # 断线重连
+        self.session = None  # 服务器发放的会话令牌
+        self.received = 0  # 本会话已收到的消息数
+        self.resume_timeout = GameServer.session_grace
+        self.join_args = None
 
     def connect(self, address, port, is_host=False):
         try:
@@ -755,39 +3103,143 @@ class NetworkClient:
     def send(self, data):
         if self.connected:
             try:
-                # 在 JSON 消息末尾添加换行符作为分隔符
-                message = json.dumps(data) + "\n"
-                self.socket.send(message.encode())
+                self.socket.sendall(encode_message(data, self.protocol))
             except Exception as e:
                 print(f"发送失败: {e}")
 
+    def close(self):
+        # 主动断开，不再自动重连
+        self.session = None
+        self.connected = False
+        if self.socket is not None:
+            try:
+                # 先 shutdown，阻塞在 recv 的接收线程才会立即返回
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+    def join(self, name, is_host=False):
+        # 加入时声明支持的协议，服务器在 player_list 中告知最终使用的协议
+        self.join_args = (name, is_host)
+        self.send(
+            {
+                "type": "join",
+                "name": name,
+                "is_host": is_host,
+                "protocols": [self.preferred_protocol],
+                "features": SUPPORTED_FEATURES,
+            }
+        )
+
     def receive_data(self):
-        buffer = ""
+        while self.connected:
+            self.read_messages(self.socket)
+            if not self.connected:
+                # 主动断开
+                break
+            if self.session is None or not self.reconnect():
+                self.connected = False
+                self.inbox.append(None)
+                notify_main_loop()
+                break
+
+    def read_messages(self, sock):
+        # 读取直到连接断开；每个连接使用新的分帧器
+        reader = self.reader = FrameReader(self.read_size)
         while self.connected:
             try:
-                data = self.socket.recv(1024).decode()
-                if not data:
-                    # 连接断开
-                    self.connected = False
-                    self.handle_disconnect()
-                    break
+                if not reader.recv_from(sock):
+                    return
 
-                buffer += data
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if line.strip() == "":
-                        continue
+                for frame in reader.read_frames():
                     try:
-                        message = json.loads(line)
-                        self.handle_message(message)
-                    except json.JSONDecodeError as e:
-                        print(f"JSON解析错误: {e}, line: {line}")
+                        message = decode_frame(frame)
+                        if message is not None:
+                            self.track(message)
+                            self.inbox.append(message)
+                    except ValueError as e:
+                        print(f"消息解析错误: {e}, frame: {frame!r}")
+                notify_main_loop()
 
             except Exception as e:
-                print(f"接收错误: {e}")
-                self.connected = False
+                if self.connected:
+                    print(f"接收错误: {e}")
+                return
+
+    def ping(self):
+        self.send({"type": "ping", "time": time.perf_counter()})
+
+    def track(self, message):
+        """会话计数、协议和往返时间必须按到达顺序在接收线程中更新"""
+        msg_type = message.get("type")
+        if msg_type == "player_list":
+            if "protocol" in message:
+                self.protocol = message["protocol"]
+            if "session" in message:
+                # 新会话从这条消息开始计数
+                self.session = message["session"]
+                self.received = 0
+        elif msg_type == "resume_failed":
+            self.session = None
+        elif msg_type == "pong":
+            if isinstance(message.get("time"), float):
+                self.rtt = time.perf_counter() - message["time"]
+        self.received += 1
+
+    def apply_pending(self):
+        """在主线程中应用收件箱里的全部消息，有变化时提交一次并返回 True"""
+        if not self.inbox:
+            return False
+        while self.inbox:
+            message = self.inbox.popleft()
+            if message is None:
                 self.handle_disconnect()
-                break
+            else:
+                self.handle_message(message)
+        self.game.commit()
+        return True
+
+    def inbound_backlog(self):
+        """还没处理的消息：(收件箱中的消息数, 套接字和分帧器中未处理的字节数)"""
+        size = 0
+        reader = self.reader
+        if reader is not None:
+            size += reader.end - reader.start
+        if fcntl is not None and self.connected:
+            try:
+                buffer = fcntl.ioctl(self.socket.fileno(), termios.FIONREAD, b"\0" * 4)
+                size += struct.unpack("i", buffer)[0]
+            except (OSError, ValueError):
+                pass
+        return len(self.inbox), size
+
+    def reconnect(self):
+        """连接断开后带着会话令牌重连，服务器补发错过的消息"""
+        deadline = time.monotonic() + self.resume_timeout
+        delay = 0.05
+        while self.connected and time.monotonic() < deadline:
+            try:
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+                sock.connect(self.server_address)
+                sock.sendall(
+                    encode_message(
+                        {
+                            "type": "resume",
+                            "session": self.session,
+                            "received": self.received,
+                        },
+                        self.protocol,
+                    )
+                )
+                self.socket = sock
+                print("已重新连接服务器")
+                return True
+            except OSError:
+                sock.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        return False
 
     def handle_disconnect(self):
         # 处理连接断开
@@ -796,7 +3248,70 @@ class NetworkClient:
 
         # 重置游戏状态
         self.game.state = GameState.LOBBY
-        self.game.players = []
+        self.game.players.clear()
+        self.game.seq = None
+
+    def apply_snapshot(self, seq, state):
+        game = self.game
+        game.players.clear()
+        for player_id, name, is_host, eliminated in state["players"]:
+            player = game.players.add(Player(player_id, name, is_host))
+            player.eliminated = eliminated
+        game.state = GameState[state["phase"]]
+        game.current_turn = state["current_turn"]
+        game.turn_count = state["turn_count"]
+        my_vote = game.my_vote
+        game.clear_votes()
+        if game.state == GameState.VOTING:
+            game.my_vote = my_vote
+            game.set_tally(*state["tally"])
+        game.word_filter = state.get("filter", {})
+        game.seq = seq
+
+    def apply_delta(self, seq, ops):
+        game = self.game
+        if game.seq is None or seq <= game.seq:
+            # 还在等待快照，或者是已经应用过的增量
+            return
+        if seq != game.seq + 1:
+            # 中间丢了增量，请求完整快照
+            game.seq = None
+            self.send({"type": "resync"})
+            return
+
+        for op in ops:
+            kind = op[0]
+            if kind == "join":
+                _, player_id, name, is_host = op
+                player = game.get_player(player_id)
+                if player is None:
+                    game.players.add(Player(player_id, name, is_host))
+                else:
+                    player.name, player.is_host = name, is_host
+            elif kind == "leave":
+                player = game.players.remove(op[1])
+                if player is not None:
+                    game.chat_history.append(f"系统: {player.name} 离开了游戏")
+            elif kind == "out":
+                player = game.get_player(op[1])
+                if player is not None:
+                    player.eliminated = True
+            elif kind == "turn":
+                _, game.current_turn, game.turn_count = op
+            elif kind == "phase":
+                game.state = GameState[op[1]]
+                if game.state == GameState.VOTING:
+                    game.clear_votes()
+            elif kind == "tally":
+                game.set_tally(op[1], op[2])
+            elif kind == "clear_votes":
+                game.clear_votes()
+            elif kind == "filter":
+                game.word_filter = op[1]
+            elif kind == "reset":
+                game.state = GameState.LOBBY
+                game.reset_round()
+        game.seq = seq
 
     def handle_message(self, message):
         # 处理服务器消息
@@ -806,31 +3321,42 @@ class NetworkClient:
             player_id = message["id"]
             player_name = message["name"]
             is_host = message["is_host"]
-            self.game.players.append(Player(player_id, player_name, is_host))
+            self.game.players.add(Player(player_id, player_name, is_host))
 
         elif msg_type == "game_start":
             self.game.state = GameState.PLAYING
             self.game.my_id = message["your_id"]
 
-            # 创建玩家列表（清空原来的）
-            self.game.players = []
-            for player_data in message["players"]:
-                player = Player(
-                    player_data["id"], player_data["name"], player_data["is_host"]
-                )
-                self.game.players.append(player)
+            if "players" in message:
+                # 创建玩家列表（清空原来的）
+                self.game.players.clear()
+                for player_data in message["players"]:
+                    self.game.players.add(
+                        Player(
+                            player_data["id"],
+                            player_data["name"],
+                            player_data["is_host"],
+                        )
+                    )
+            else:
+                # 增量同步时玩家列表已是最新，只清空上一局的状态
+                for player in self.game.players:
+                    player.word = ""
+                    player.is_undercover = False
+                    player.eliminated = False
+                    player.votes = 0
+                    player.message = ""
 
             # 设置自己的词语和身份
-            my_player = next(p for p in self.game.players if p.id == self.game.my_id)
-            my_player.word = message["word"]
-            my_player.is_undercover = message["is_undercover"]
+            my_player = self.game.players.me
+            if my_player is not None:
+                my_player.word = message["word"]
+                my_player.is_undercover = message["is_undercover"]
 
         elif msg_type == "player_eliminated":
-            player_id = message["player_id"]
-            for player in self.game.players:
-                if player.id == player_id:
-                    player.eliminated = True
-                    break
+            player = self.game.get_player(message["player_id"])
+            if player is not None:
+                player.eliminated = True
 
         elif msg_type == "game_over":
             self.game.state = GameState.RESULT
@@ -848,34 +3374,25 @@ class NetworkClient:
                         int(player_id) if isinstance(player_id, str) else player_id
                     )
 
-                    for player in self.game.players:
-                        if player.id == player_id_int:
-                            player.word = word
-                            # 设置卧底身份
-                            if (
-                                hasattr(self.game, "undercover_id")
-                                and player.id == self.game.undercover_id
-                            ):
-                                player.is_undercover = True
-                            else:
-                                player.is_undercover = False  # 明确设置为非卧底
-                            break
+                    player = self.game.get_player(player_id_int)
+                    if player is not None:
+                        player.word = word
+                        # 设置卧底身份，其他人明确设置为非卧底
+                        player.is_undercover = player.id == self.game.undercover_id
 
         elif msg_type == "new_message":
-            player_id = message["player_id"]
             msg = message["message"]
-            for player in self.game.players:
-                if player.id == player_id:
-                    player.message = msg
-                    self.game.chat_history.append(f"{player.name}: {msg}")
-                    break
+            player = self.game.get_player(message["player_id"])
+            if player is not None:
+                player.message = msg
+                self.game.chat_history.append(f"{player.name}: {msg}")
 
         elif msg_type == "player_left":
             player_id = message["player_id"]
             player_name = message["player_name"]
 
             # 从玩家列表中移除
-            self.game.players = [p for p in self.game.players if p.id != player_id]
+            self.game.players.remove(player_id)
 
             # 添加到聊天历史
             self.game.chat_history.append(f"系统: {player_name} 离开了游戏")
@@ -889,11 +3406,26 @@ class NetworkClient:
                 self.game.next_turn()
 
         elif msg_type == "next_turn":
+            self.game.state = GameState.PLAYING
             self.game.current_turn = message["current_turn"]
-            self.game.turn_count += 1
+            self.game.turn_count = message.get("turn_count", self.game.turn_count + 1)
 
         elif msg_type == "voting_start":
             self.game.state = GameState.VOTING
+            self.game.clear_votes()
+
+        elif msg_type == "vote_progress":
+            self.game.set_tally(message["counts"], message["voted"])
+
+        elif msg_type == "vote_result":
+            # 服务器的结算结果，接下来会收到下一回合或游戏结束
+            eliminated = self.game.get_player(message["eliminated"])
+            if eliminated is not None:
+                eliminated.eliminated = True
+                self.game.chat_history.append(f"系统: {eliminated.name} 被淘汰")
+            else:
+                self.game.chat_history.append("系统: 平票，没有人被淘汰")
+            self.game.clear_votes()
 
         elif msg_type == "player_list":
             # 保存自己的ID和主机状态
@@ -901,23 +3433,38 @@ class NetworkClient:
                 self.game.my_id = message["your_id"]
             if "is_host" in message:
                 self.host = message["is_host"]
+            if self.host:
+                # 主机可以选择词条范围，先取得可选的标签
+                self.send({"type": "list_word_tags"})
 
-            for player_data in message["players"]:
-                self.game.players.append(
+            # 增量同步的客户端不带玩家列表，随后会收到完整快照
+            for player_data in message.get("players", ()):
+                self.game.players.add(
                     Player(
                         player_data["id"], player_data["name"], player_data["is_host"]
                     )
                 )
 
-        elif msg_type == "vote":
-            voter_id = message["voter_id"]
-            target_id = message["target_id"]
-            self.game.vote(voter_id, target_id)
+        elif msg_type == "state_snapshot":
+            self.apply_snapshot(message["seq"], message["state"])
+
+        elif msg_type == "state_delta":
+            self.apply_delta(message["seq"], message["ops"])
 
-            # 检查是否所有玩家都已投票
-            active_players = [p for p in self.game.players if not p.eliminated]
-            if len(self.game.votes) >= len(active_players):
-                self.check_voting_result()
+        elif msg_type == "word_filter":
+            self.game.word_filter = message["filter"]
+
+        elif msg_type == "word_tags":
+            self.game.word_tags = message["tags"]
+
+        elif msg_type == "resumed":
+            self.game.chat_history.append("系统: 已恢复连接")
+
+        elif msg_type == "resume_failed":
+            # 会话已过期，重新加入
+            self.handle_disconnect()
+            if self.join_args is not None:
+                self.join(*self.join_args)
 
         elif msg_type == "error":
             # 显示错误消息
@@ -926,89 +3473,44 @@ class NetworkClient:
         elif msg_type == "game_reset":
             # 重置游戏状态
             self.game.state = GameState.LOBBY
-            self.game.players = []
+            self.game.players.clear()
 
             # 重新添加玩家
             for player_data in message["players"]:
-                player = Player(
-                    player_data["id"], player_data["name"], player_data["is_host"]
+                self.game.players.add(
+                    Player(
+                        player_data["id"], player_data["name"], player_data["is_host"]
+                    )
                 )
-                # 重置玩家状态
-                player.eliminated = False
-                player.word = ""
-                player.is_undercover = False
-                player.votes = 0
-                player.message = ""
-                self.game.players.append(player)
 
             # 清空聊天记录和其他游戏状态
-            self.game.chat_history = []
-            self.game.votes = {}
-            self.game.current_turn = 0
-            self.game.turn_count = 0
-            self.game.winner = None
-            self.game.undercover_id = None
-
-            # 重置客户端特定的投票状态
-            self.selected_vote_target = None
-            self.has_voted = False
-
-    def check_voting_result(self):
-        # 计算每个玩家的得票数
-        vote_counts = {}
-        for target_id in self.game.votes.values():
-            vote_counts[target_id] = vote_counts.get(target_id, 0) + 1
-
-        # 找到得票最多的玩家
-        max_votes = max(vote_counts.values()) if vote_counts else 0
-        candidates = [pid for pid, votes in vote_counts.items() if votes == max_votes]
-
-        # 如果只有一个得票最多的玩家，淘汰该玩家
-        if len(candidates) == 1:
-            eliminated_id = candidates[0]
-
-            # 标记被淘汰的玩家
-            for player in self.game.players:
-                if player.id == eliminated_id:
-                    player.eliminated = True
-                    break
+            self.game.reset_round()
 
-            # 检查游戏是否结束
-            if eliminated_id == self.game.undercover_id:
-                # 卧底被淘汰，平民胜利
-                self.game.state = GameState.RESULT
-                self.game.winner = "平民"
-            else:
-                # 游戏继续，进入下一轮
-                self.game.state = GameState.PLAYING
-                self.game.next_turn()
-        else:
-            # 平票，继续游戏
-            self.game.state = GameState.PLAYING
-            self.game.next_turn()
 
-        # 重置投票状态
-        self.game.votes = {}
-        self.selected_vote_target = None
-        self.has_voted = False
+# 等待房间中词条标签的显示名称
+WORD_TAG_LABELS = {"category": "分类", "difficulty": "难度", "language": "语言"}
 
 
 # 主游戏类
 class UndercoverGame:
-    def __init__(self):
+    def __init__(self, max_fps=60, server_mode="thread", protocol=PROTOCOL_JSON):
         self.server = None
+        self.server_mode = server_mode
+        self.protocol = protocol  # 连接服务器时请求的线路协议
         pygame.init()
-        self.has_voted = False
         self.width, self.height = 1000, 700
         self.screen = pygame.display.set_mode((self.width, self.height))
         pygame.display.set_caption("谁是卧底")
 
-        self.clock = pygame.time.Clock()
-        self.font = pygame.font.Font("default.ttf", 28)
-        self.small_font = pygame.font.Font("default.ttf", 24)
+        self.scheduler = FrameScheduler(max_fps)
+        self.perf = PerfOverlay()
+        # 启动时一次性加载界面用到的所有字号
+        fonts.preload((18, 24, 28, 36, 48))
+        self.font = fonts.get(28)
+        self.small_font = fonts.get(24)
 
         self.game = Game()
-        self.network = NetworkClient(self.game)
+        self.network = NetworkClient(self.game, self.protocol)
 
         # 创建UI元素
         self.name_input = TextInputBox(400, 250, 200, 40, self.font, "游戏名字")
@@ -1031,10 +3533,28 @@ class UndercoverGame:
         self.start_button = Button(
             400, 560, 200, 40, "开始游戏", self.font, on_click=self.start_game
         )
+        # 主机在等待房间里按标签选择词条范围，点击切换到下一个取值
+        self.filter_buttons = {
+            tag: Button(
+                600,
+                120 + i * 50,
+                350,
+                40,
+                "",
+                self.small_font,
+                on_click=lambda tag=tag: self.cycle_word_filter(tag),
+            )
+            for i, tag in enumerate(TAG_FIELDS)
+        }
         self.vote_buttons = []
 
-        # 当前选中的投票目标
-        self.selected_vote_target = None
+        # 保留模式渲染：画面没有变化时不重绘，只更新变化的矩形区域
+        self.retained = True
+        self.full_redraw = True
+        self.scene_key = None
+        self.row_keys = []
+        self.chat_key = None
+        self.drawn_version = None  # 上次绘制时的状态版本
 
     def join_game(self):
         name = self.name_input.get_value()
@@ -1043,7 +3563,7 @@ class UndercoverGame:
 
         if name and host and port:
             if self.network.connect(host, port, is_host=False):
-                self.network.send({"type": "join", "name": name})
+                self.network.join(name)
 
     def host_game(self):
         name = self.name_input.get_value()
@@ -1054,24 +3574,52 @@ class UndercoverGame:
             if (self.server is not None) and self.server.running:
                 # 已经有一个服务器在运行，直接连接
                 if self.network.connect("127.0.0.1", port, is_host=True):
-                    self.network.send({"type": "join", "name": name, "is_host": True})
+                    self.network.join(name, is_host=True)
                 return
 
             # 启动服务器
-            self.server = GameServer(self.host_input.get_value(), port)
+            self.server = create_server(
+                self.server_mode, self.host_input.get_value(), port
+            )
             self.server.start()
 
             # 作为主机客户端连接自己
             if self.network.connect("127.0.0.1", port, is_host=True):
                 # 发送 join 消息
-                self.network.send({"type": "join", "name": name, "is_host": True})
+                self.network.join(name, is_host=True)
+
+    def is_room_host(self):
+        # 使用服务器返回的主机状态，而不是本地的network.host
+        my_player = self.game.players.me
+        return bool(my_player and my_player.is_host)
+
+    def visible_filter_buttons(self):
+        if not (self.network.connected and self.game.state == GameState.LOBBY):
+            return []
+        if not self.is_room_host():
+            return []
+        return [
+            button
+            for tag, button in self.filter_buttons.items()
+            if self.game.word_tags.get(tag)
+        ]
+
+    def cycle_word_filter(self, tag):
+        options = [None] + self.game.word_tags.get(tag, [])
+        current = self.game.word_filter.get(tag)
+        index = options.index(current) if current in options else 0
+        word_filter = dict(self.game.word_filter)
+        word_filter[tag] = options[(index + 1) % len(options)]
+        self.network.send(
+            {
+                "type": "set_word_filter",
+                "filter": {k: v for k, v in word_filter.items() if v},
+            }
+        )
 
     def start_game(self):
         if self.network.host and self.network.connected:
             self.network.send({"type": "start_game"})
-            # 重置投票状态
-            self.selected_vote_target = None
-            self.has_voted = False
 
     def send_message(self, message):
         if self.network.connected and message:
@@ -1079,16 +3627,28 @@ class UndercoverGame:
             self.message_input.reset()
 
     def vote(self, target_id):
-        if self.network.connected and target_id and not self.has_voted:
+        if self.network.connected and target_id and self.game.my_vote is None:
             self.network.send({"type": "vote", "target_id": target_id})
-            self.has_voted = True  # 设置已投票标志
+            self.game.my_vote = target_id  # 本轮已投票，结算后由服务器消息清除
+            self.game.commit()
 
-    def handle_events(self):
-        for event in pygame.event.get():
+    def handle_events(self, events=None):
+        if events is None:
+            events = pygame.event.get()
+        for event in events:
             if event.type == pygame.QUIT:
                 self.quit_game()
                 return False
 
+            # 窗口被遮挡或恢复后需要整屏重绘
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                self.full_redraw = True
+
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                # 切换性能面板，关闭时重绘被面板覆盖的区域
+                self.perf.visible = not self.perf.visible
+                self.full_redraw = True
+
             self.name_input.handle_event(event)
             self.host_input.handle_event(event)
             self.port_input.handle_event(event)
@@ -1096,6 +3656,8 @@ class UndercoverGame:
             self.join_button.handle_event(event)
             self.host_button.handle_event(event)
             self.start_button.handle_event(event)
+            for filter_button in self.visible_filter_buttons():
+                filter_button.handle_event(event)
 
             for vote_button in self.vote_buttons:
                 vote_button.handle_event(event)
@@ -1106,10 +3668,7 @@ class UndercoverGame:
                     if message_text:
                         if self.game.state == GameState.PLAYING:
                             # 检查是否是当前回合
-                            if (
-                                self.game.players[self.game.current_turn].id
-                                == self.game.my_id
-                            ):
+                            if self.game.is_my_turn():
                                 self.send_message(message_text)
                         elif self.game.state == GameState.VOTING:
                             # 投票阶段发送普通聊天消息
@@ -1124,7 +3683,6 @@ class UndercoverGame:
                     if player.id != self.game.my_id and not player.eliminated:
                         button_rect = pygame.Rect(800, 150 + i * 60, 150, 40)
                         if button_rect.collidepoint(event.pos):
-                            self.selected_vote_target = player.id
                             # 直接发送投票，不需要再按回车
                             self.vote(player.id)
 
@@ -1139,10 +3697,8 @@ class UndercoverGame:
     def restart_game(self):
         if self.network.connected:
             # 检查是否是主机
-            my_player = next(
-                (p for p in self.game.players if p.id == self.game.my_id), None
-            )
-            is_host = my_player and my_player.is_host if my_player else False
+            my_player = self.game.players.me
+            is_host = my_player.is_host if my_player else False
 
             if is_host:
                 # 主机发送重新开始请求
@@ -1152,46 +3708,166 @@ class UndercoverGame:
                 self.quit_game()
                 # 重置游戏状态
                 self.game = Game()
-                self.network = NetworkClient(self.game)
+                self.network = NetworkClient(self.game, self.protocol)
+
+    def get_scene_key(self):
+        # 除输入框、按钮、玩家行和聊天区以外，画面上所有会变化的内容
+        return (
+            self.network.connected,
+            self.game.state,
+            self.game.my_id,
+            self.game.current_turn,
+            self.game.winner,
+            self.game.voted,
+            self.game.my_vote,
+            tuple(p.votes for p in self.game.players),
+            tuple(
+                (p.id, p.name, p.is_host, p.word, p.is_undercover, p.eliminated)
+                for p in self.game.players
+            ),
+            tuple(sorted(self.game.word_filter.items())),
+            len(self.game.word_tags),
+        )
+
+    def get_chat_key(self):
+        history = self.game.chat_history
+        return len(history), history[-1] if history else None
+
+    def get_visible_widgets(self):
+        if not self.network.connected:
+            return [
+                self.name_input,
+                self.host_input,
+                self.port_input,
+                self.join_button,
+                self.host_button,
+            ]
+        if self.game.state == GameState.LOBBY:
+            return [self.start_button] + self.visible_filter_buttons()
+        if self.game.state in (GameState.PLAYING, GameState.VOTING):
+            return [self.message_input]
+        return []
+
+    def player_row_rect(self, index):
+        # 玩家框加上投票阶段右侧的投票按钮
+        return pygame.Rect(50, 150 + index * 60, 900, 50)
+
+    def chat_panel_rect(self):
+        top = 150 + len(self.game.players) * 60 + 20
+        return pygame.Rect(0, top, self.width, 5 * 25 + 40)
 
     def draw(self):
+        widgets = self.get_visible_widgets()
+        # 状态没有提交新版本时，画面内容只可能因为连接状态变化
+        state_changed = self.game.version != self.drawn_version
+        if state_changed:
+            scene_key = self.get_scene_key()
+        else:
+            scene_key = (self.network.connected,) + self.scene_key[1:]
+
+        if not self.retained or self.full_redraw or scene_key != self.scene_key:
+            self.draw_scene()
+            if self.perf.visible:
+                self.perf.layout(self.screen, self.network)
+                self.perf.draw(self.screen)
+            started = time.perf_counter()
+            pygame.display.flip()
+            self.perf.record("display.flip", started)
+            self.full_redraw = False
+            self.scene_key = scene_key
+        else:
+            # 收集发生变化的区域
+            dirty_rects = [w.rect.inflate(4, 4) for w in widgets if w.dirty]
+            if state_changed and self.game.state in (
+                GameState.PLAYING,
+                GameState.VOTING,
+            ):
+                for i, player in enumerate(self.game.players):
+                    row_key = player.render_key()
+                    if i >= len(self.row_keys) or self.row_keys[i] != row_key:
+                        dirty_rects.append(self.player_row_rect(i))
+                if self.get_chat_key() != self.chat_key:
+                    dirty_rects.append(self.chat_panel_rect())
+
+            if self.perf.visible:
+                # 面板每帧都会变化，先在面板区域重绘场景再画面板；
+                # 面板可能变高或变矮，新旧两个位置都要重绘
+                dirty_rects.append(self.perf.rect)
+                dirty_rects.append(self.perf.layout(self.screen, self.network))
+            if dirty_rects:
+                # 以所有变化矩形的并集为裁剪区只重绘一遍场景，
+                # 再只把这些矩形推送到屏幕
+                self.screen.set_clip(dirty_rects[0].unionall(dirty_rects[1:]))
+                self.draw_scene()
+                self.screen.set_clip(None)
+                if self.perf.visible:
+                    self.perf.draw(self.screen)
+                started = time.perf_counter()
+                pygame.display.update(dirty_rects)
+                self.perf.record("display.update", started)
+
+        if state_changed:
+            self.row_keys = [p.render_key() for p in self.game.players]
+            self.chat_key = self.get_chat_key()
+            self.drawn_version = self.game.version
+        for widget in (
+            self.name_input,
+            self.host_input,
+            self.port_input,
+            self.message_input,
+            self.join_button,
+            self.host_button,
+            self.start_button,
+            *self.filter_buttons.values(),
+        ):
+            widget.dirty = False
+
+    def draw_scene(self):
         self.screen.fill(Colors.BACKGROUND)
 
         # 显示连接状态
         if not self.network.connected and self.game.state != GameState.LOBBY:
-            status_text = self.font.render("与服务器断开连接", True, Colors.RED)
+            status_text = text_cache.render(
+                self.font, "与服务器断开连接", True, Colors.RED
+            )
             self.screen.blit(status_text, (10, 10))
 
         if not self.network.connected:
-            self.draw_lobby()
+            draw_screen = self.draw_lobby
+        elif self.game.state == GameState.LOBBY:
+            draw_screen = self.draw_waiting_room
+        elif self.game.state == GameState.PLAYING:
+            draw_screen = self.draw_game
+        elif self.game.state == GameState.VOTING:
+            draw_screen = self.draw_voting
         else:
-            if self.game.state == GameState.LOBBY:
-                self.draw_waiting_room()
-            elif self.game.state == GameState.PLAYING:
-                self.draw_game()
-            elif self.game.state == GameState.VOTING:
-                self.draw_voting()
-            elif self.game.state == GameState.RESULT:
-                self.draw_result()
-
-        pygame.display.flip()
+            draw_screen = self.draw_result
+        started = time.perf_counter()
+        draw_screen()
+        self.perf.record(draw_screen.__name__, started)
 
     def draw_lobby(self):
         # 绘制标题
-        title_font = pygame.font.Font("default.ttf", 48)
-        title_surface = title_font.render("谁是卧底", True, Colors.BLUE)
+        title_font = fonts.get(48)
+        title_surface = text_cache.render(title_font, "谁是卧底", True, Colors.BLUE)
         self.screen.blit(
             title_surface, (self.width // 2 - title_surface.get_width() // 2, 100)
         )
 
         # 绘制输入框和按钮
-        self.screen.blit(self.font.render("名字:", True, Colors.BLACK), (300, 260))
+        self.screen.blit(
+            text_cache.render(self.font, "名字:", True, Colors.BLACK), (300, 260)
+        )
         self.name_input.draw(self.screen)
 
-        self.screen.blit(self.font.render("服务器IP:", True, Colors.BLACK), (245, 330))
+        self.screen.blit(
+            text_cache.render(self.font, "服务器IP:", True, Colors.BLACK), (245, 330)
+        )
         self.host_input.draw(self.screen)
 
-        self.screen.blit(self.font.render("端口:", True, Colors.BLACK), (300, 400))
+        self.screen.blit(
+            text_cache.render(self.font, "端口:", True, Colors.BLACK), (300, 400)
+        )
         self.port_input.draw(self.screen)
 
         self.join_button.draw(self.screen)
@@ -1208,60 +3884,75 @@ class UndercoverGame:
         ]
 
         for i, line in enumerate(instructions):
-            text_surface = self.small_font.render(line, True, Colors.BLACK)
+            text_surface = text_cache.render(self.small_font, line, True, Colors.BLACK)
             self.screen.blit(text_surface, (50, 450 + i * 30))
 
     def draw_waiting_room(self):
         # 绘制标题
-        title_font = pygame.font.Font("default.ttf", 48)
-        title_surface = title_font.render("等待房间", True, Colors.BLUE)
+        title_font = fonts.get(48)
+        title_surface = text_cache.render(title_font, "等待房间", True, Colors.BLUE)
         self.screen.blit(
             title_surface, (self.width // 2 - title_surface.get_width() // 2, 50)
         )
 
         # 绘制玩家列表
-        self.screen.blit(self.font.render("玩家列表:", True, Colors.BLACK), (50, 120))
+        self.screen.blit(
+            text_cache.render(self.font, "玩家列表:", True, Colors.BLACK), (50, 120)
+        )
         for i, player in enumerate(self.game.players):
             player_status = f"{player.name} {'(主机)' if player.is_host else ''}"
-            text_surface = self.font.render(player_status, True, Colors.BLACK)
+            text_surface = text_cache.render(
+                self.font, player_status, True, Colors.BLACK
+            )
             self.screen.blit(text_surface, (50, 160 + i * 40))
 
-        # 显示开始按钮（仅主机）
-        # 使用服务器返回的主机状态，而不是本地的network.host
-        my_player = next(
-            (p for p in self.game.players if p.id == self.game.my_id), None
-        )
-        is_host = my_player and my_player.is_host if my_player else False
+        # 词条范围：主机可以点击切换，其他玩家只能查看
+        filter_buttons = self.visible_filter_buttons()
+        for tag, button in self.filter_buttons.items():
+            if button in filter_buttons:
+                value = self.game.word_filter.get(tag, "全部")
+                button.text = f"{WORD_TAG_LABELS[tag]}: {value}"
+                button.draw(self.screen)
+        if self.game.word_filter and not filter_buttons:
+            filter_text = " / ".join(self.game.word_filter.values())
+            self.screen.blit(
+                text_cache.render(
+                    self.small_font, f"词条范围: {filter_text}", True, Colors.BLACK
+                ),
+                (600, 120),
+            )
 
-        if is_host:
+        # 显示开始按钮（仅主机）
+        if self.is_room_host():
             self.start_button.draw(self.screen)
         else:
-            waiting_text = self.font.render("等待主机开始游戏...", True, Colors.BLACK)
+            waiting_text = text_cache.render(
+                self.font, "等待主机开始游戏...", True, Colors.BLACK
+            )
             self.screen.blit(waiting_text, (400, 500))
 
     def draw_game(self):
         # 绘制标题
-        title_font = pygame.font.Font("default.ttf", 36)
+        title_font = fonts.get(36)
         title_text = "游戏进行中 - 描述你的词语"
-        title_surface = title_font.render(title_text, True, Colors.BLUE)
+        title_surface = text_cache.render(title_font, title_text, True, Colors.BLUE)
         self.screen.blit(
             title_surface, (self.width // 2 - title_surface.get_width() // 2, 20)
         )
 
         # 显示自己的词语
-        my_player = next(
-            (p for p in self.game.players if p.id == self.game.my_id), None
-        )
+        my_player = self.game.players.me
         if my_player:
-            word_text = self.font.render(
-                f"你的词语: {my_player.word}", True, Colors.BLACK
+            word_text = text_cache.render(
+                self.font, f"你的词语: {my_player.word}", True, Colors.BLACK
             )
             self.screen.blit(word_text, (50, 70))
 
         # 显示当前回合
-        current_player = self.game.players[self.game.current_turn]
-        turn_text = self.font.render(
-            f"当前回合: {current_player.name}", True, Colors.BLACK
+        current_player = self.game.current_player()
+        current_name = current_player.name if current_player else ""
+        turn_text = text_cache.render(
+            self.font, f"当前回合: {current_name}", True, Colors.BLACK
         )
         self.screen.blit(turn_text, (50, 100))
 
@@ -1271,37 +3962,41 @@ class UndercoverGame:
             player.draw(self.screen, 50, 150 + i * 60, 700, 50, is_me, self.game.state)
 
         # 绘制聊天历史
-        chat_title = self.font.render("聊天记录:", True, Colors.BLACK)
+        chat_title = text_cache.render(self.font, "聊天记录:", True, Colors.BLACK)
         self.screen.blit(chat_title, (50, 150 + len(self.game.players) * 60 + 20))
 
         for i, msg in enumerate(self.game.chat_history[-5:]):
-            msg_surface = self.small_font.render(msg, True, Colors.BLACK)
+            msg_surface = text_cache.render(self.small_font, msg, True, Colors.BLACK)
             self.screen.blit(
                 msg_surface, (50, 200 + len(self.game.players) * 60 + i * 25)
             )
 
         # 绘制输入框
-        if self.game.players[self.game.current_turn].id == self.game.my_id:
+        if self.game.is_my_turn():
             self.message_input.draw(self.screen)
-            hint_text = self.small_font.render("按回车发送描述", True, Colors.BLACK)
+            hint_text = text_cache.render(
+                self.small_font, "按回车发送描述", True, Colors.BLACK
+            )
             self.screen.blit(hint_text, (760, 660))
         else:
-            waiting_text = self.font.render("请等待其他玩家描述...", True, Colors.BLACK)
+            waiting_text = text_cache.render(
+                self.font, "请等待其他玩家描述...", True, Colors.BLACK
+            )
             self.screen.blit(waiting_text, (300, 660))
 
     def draw_voting(self):
         # 绘制标题
-        title_font = pygame.font.Font("default.ttf", 36)
+        title_font = fonts.get(36)
 
         # 检查是否已经投票
-        has_voted = self.has_voted or self.selected_vote_target is not None
+        has_voted = self.game.my_vote is not None
 
         if has_voted:
             title_text = "投票阶段 - 已投票，等待其他玩家"
         else:
             title_text = "投票阶段 - 选出你认为的卧底"
 
-        title_surface = title_font.render(title_text, True, Colors.RED)
+        title_surface = text_cache.render(title_font, title_text, True, Colors.RED)
         self.screen.blit(
             title_surface, (self.width // 2 - title_surface.get_width() // 2, 20)
         )
@@ -1314,9 +4009,7 @@ class UndercoverGame:
             # 绘制投票按钮（不能投自己，且未投票时才显示）
             if player.id != self.game.my_id and not player.eliminated and not has_voted:
                 button_color = (
-                    Colors.RED
-                    if self.selected_vote_target == player.id
-                    else Colors.GRAY
+                    Colors.RED if self.game.my_vote == player.id else Colors.GRAY
                 )
                 button_rect = pygame.Rect(800, 150 + i * 60, 150, 40)
                 pygame.draw.rect(
@@ -1326,7 +4019,9 @@ class UndercoverGame:
                     self.screen, Colors.BLACK, button_rect, 2, border_radius=5
                 )
 
-                vote_text = self.small_font.render("投票", True, Colors.BLACK)
+                vote_text = text_cache.render(
+                    self.small_font, "投票", True, Colors.BLACK
+                )
                 self.screen.blit(
                     vote_text,
                     (
@@ -1336,59 +4031,61 @@ class UndercoverGame:
                 )
 
         # 显示提示
-        if self.selected_vote_target:
-            target_player = next(
-                (p for p in self.game.players if p.id == self.selected_vote_target),
-                None,
-            )
+        if has_voted:
+            target_player = self.game.get_player(self.game.my_vote)
             if target_player:
-                hint_text = self.font.render(
-                    f"已投票给: {target_player.name}", True, Colors.BLACK
+                hint_text = text_cache.render(
+                    self.font, f"已投票给: {target_player.name}", True, Colors.BLACK
                 )
                 self.screen.blit(hint_text, (50, 100))
         else:
-            hint_text = self.font.render("请选择你要投票的玩家", True, Colors.BLACK)
+            hint_text = text_cache.render(
+                self.font, "请选择你要投票的玩家", True, Colors.BLACK
+            )
             self.screen.blit(hint_text, (50, 100))
 
         # 显示投票进度
         active_players = [p for p in self.game.players if not p.eliminated]
-        progress_text = self.font.render(
-            f"投票进度: {len(self.game.votes)}/{len(active_players)}",
+        progress_text = text_cache.render(
+            self.font,
+            f"投票进度: {self.game.voted}/{len(active_players)}",
             True,
             Colors.BLACK,
         )
         self.screen.blit(progress_text, (700, 100))
 
         # 绘制聊天历史
-        chat_title = self.font.render("聊天记录:", True, Colors.BLACK)
+        chat_title = text_cache.render(self.font, "聊天记录:", True, Colors.BLACK)
         self.screen.blit(chat_title, (50, 150 + len(self.game.players) * 60 + 20))
 
         for i, msg in enumerate(self.game.chat_history[-5:]):
-            msg_surface = self.small_font.render(msg, True, Colors.BLACK)
+            msg_surface = text_cache.render(self.small_font, msg, True, Colors.BLACK)
             self.screen.blit(
                 msg_surface, (50, 200 + len(self.game.players) * 60 + i * 25)
             )
 
         # 绘制输入框 - 在投票阶段也显示输入框，让玩家可以讨论
         self.message_input.draw(self.screen)
-        hint_text = self.small_font.render("按回车发送消息讨论", True, Colors.BLACK)
+        hint_text = text_cache.render(
+            self.small_font, "按回车发送消息讨论", True, Colors.BLACK
+        )
         self.screen.blit(hint_text, (760, 660))
 
         # 显示等待提示
         if has_voted:
-            waiting_text = self.font.render(
-                "已投票，等待其他玩家...", True, Colors.BLACK
+            waiting_text = text_cache.render(
+                self.font, "已投票，等待其他玩家...", True, Colors.BLACK
             )
             self.screen.blit(waiting_text, (400, 620))
 
     def draw_result(self):
         # 绘制标题
-        title_font = pygame.font.Font("default.ttf", 48)
+        title_font = fonts.get(48)
         title_text = f"游戏结束 - {self.game.winner}胜利"
         color = Colors.GREEN
         if self.game.winner == "卧底":
             color = Colors.RED
-        title_surface = title_font.render(title_text, True, color)
+        title_surface = text_cache.render(title_font, title_text, True, color)
         self.screen.blit(
             title_surface, (self.width // 2 - title_surface.get_width() // 2, 50)
         )
@@ -1396,8 +4093,8 @@ class UndercoverGame:
         # 显示卧底信息
         undercover = next((p for p in self.game.players if p.is_undercover), None)
         if undercover:
-            undercover_text = self.font.render(
-                f"卧底是: {undercover.name}", True, Colors.RED
+            undercover_text = text_cache.render(
+                self.font, f"卧底是: {undercover.name}", True, Colors.RED
             )
             self.screen.blit(
                 undercover_text,
@@ -1405,21 +4102,22 @@ class UndercoverGame:
             )
 
         # 显示所有玩家的词语
-        words_text = self.font.render("玩家词语:", True, Colors.BLACK)
+        words_text = text_cache.render(self.font, "玩家词语:", True, Colors.BLACK)
         self.screen.blit(words_text, (50, 180))
 
         for i, player in enumerate(self.game.players):
             word_type = "卧底词" if player.is_undercover else "平民词"
-            player_text = self.font.render(
-                f"{player.name}: {player.word} ({word_type})", True, Colors.BLACK
+            player_text = text_cache.render(
+                self.font,
+                f"{player.name}: {player.word} ({word_type})",
+                True,
+                Colors.BLACK,
             )
             self.screen.blit(player_text, (50, 220 + i * 40))
 
         # 显示重新开始按钮（仅主机）或返回按钮（非主机）
-        my_player = next(
-            (p for p in self.game.players if p.id == self.game.my_id), None
-        )
-        is_host = my_player and my_player.is_host if my_player else False
+        my_player = self.game.players.me
+        is_host = my_player.is_host if my_player else False
 
         if is_host:
             _restart_button = Button(
@@ -1451,12 +4149,29 @@ class UndercoverGame:
         self.quit_game()
         # 重置游戏状态
         self.game = Game()
-        self.network = NetworkClient(self.game)
+        self.network = NetworkClient(self.game, self.protocol)
+
+    def get_wait_timeout(self):
+        # 空闲时最多等到下一次光标闪烁；性能面板打开时每秒刷新几次
+        timeout = self.scheduler.idle_timeout_ms
+        if self.perf.visible:
+            timeout = min(timeout, 250)
+        for text_input in (
+            self.name_input,
+            self.message_input,
+            self.host_input,
+            self.port_input,
+        ):
+            if text_input.active:
+                remaining = text_input.cursor_switch_ms - text_input.cursor_ms_counter
+                timeout = min(timeout, remaining)
+        return max(timeout, 1)
 
     def run(self):
         running = True
         while running:
-            dt = self.clock.tick(60)
+            events = self.scheduler.wait_events(self.get_wait_timeout())
+            dt = self.scheduler.tick()
 
             # 更新输入框
             self.name_input.update(dt)
@@ -1464,14 +4179,21 @@ class UndercoverGame:
             self.host_input.update(dt)
             self.port_input.update(dt)
 
+            # 每帧在同一个位置应用网络线程收到的消息
+            started = time.perf_counter()
+            self.network.apply_pending()
+            self.perf.record("network", started)
+
             # 处理事件
-            running = self.handle_events()
+            started = time.perf_counter()
+            running = self.handle_events(events)
+            self.perf.record("handle_events", started)
 
             # 绘制游戏
             self.draw()
-
-            # 控制帧率
-            self.clock.tick(60)
+            if self.perf.visible and self.network.connected and self.perf.should_ping():
+                self.network.ping()
+            self.perf.end_frame()
 
         pygame.quit()
         sys.exit()
@@ -1481,9 +4203,7 @@ class UndercoverGame:
             try:
                 # 发送退出消息
                 self.network.send({"type": "quit"})
-                self.network.connected = False
-                if hasattr(self.network, "socket"):
-                    self.network.socket.close()
+                self.network.close()
             except Exception as e:
                 print(e)
 
@@ -1491,11 +4211,88 @@ class UndercoverGame:
         # 这样主机可以继续使用同一个服务器端口
 
         # 重置客户端状态
-        self.has_voted = False
-        self.selected_vote_target = None
+        self.game.clear_votes()
+        self.game.commit()
 
 
 # 启动游戏
 if __name__ == "__main__":
-    game = UndercoverGame()
-    game.run()
+    parser = argparse.ArgumentParser(description="谁是卧底")
+    parser.add_argument("--server", action="store_true", help="只运行服务器")
+    parser.add_argument("--host", default="::", help="服务器监听地址")
+    parser.add_argument("--port", type=int, default=12345, help="服务器端口")
+    parser.add_argument("--server-mode", choices=sorted(SERVER_MODES), default="thread")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="服务器工作进程数（仅 --server）"
+    )
+    parser.add_argument(
+        "--slow-policy",
+        choices=SLOW_CONSUMER_POLICIES,
+        default="drop_chat",
+        help="客户端发送缓冲区超过高水位后的处理策略",
+    )
+    parser.add_argument(
+        "--high-water", type=int, default=256, help="发送缓冲区高水位（KB）"
+    )
+    parser.add_argument(
+        "--flush-window",
+        type=float,
+        default=0,
+        help="合并写出的时间窗（毫秒，建议 5-20），0 表示立即写出",
+    )
+    parser.add_argument(
+        "--nodelay",
+        choices=("on", "off"),
+        help="是否设置 TCP_NODELAY，默认保持系统设置",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="在 127.0.0.1 的这个端口上提供运行指标（/metrics, /metrics.json）",
+    )
+    parser.add_argument("--max-fps", type=int, default=60, help="客户端帧率上限")
+    parser.add_argument(
+        "--protocol",
+        choices=(PROTOCOL_JSON, PROTOCOL_BINARY),
+        default=PROTOCOL_JSON,
+        help="客户端的线路协议：json 编解码更快，bin1 消息小 60%% 左右",
+    )
+    args = parser.parse_args()
+    backpressure = Backpressure(args.slow_policy, args.high_water * 1024)
+    batching = WriteBatching(
+        args.flush_window / 1000,
+        None if args.nodelay is None else args.nodelay == "on",
+    )
+
+    if args.server and args.workers > 1:
+        ShardedGameServer(
+            args.host,
+            args.port,
+            args.workers,
+            args.server_mode,
+            backpressure,
+            batching,
+            args.metrics_port,
+        ).serve_forever()
+    elif args.server:
+        server = create_server(
+            args.server_mode,
+            args.host,
+            args.port,
+            backpressure=backpressure,
+            batching=batching,
+        )
+        if args.metrics_port is not None:
+            server.serve_metrics(port=args.metrics_port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            stats = batching.stats()
+            print(
+                f"写出 {stats['writes']} 次，共 {stats['messages']} 条消息，"
+                f"平均每次 {stats['messages_per_write']:.2f} 条，"
+                f"节省 {stats['syscalls_saved']} 次系统调用"
+            )
+    else:
+        game = UndercoverGame(args.max_fps, args.server_mode, args.protocol)
+        game.run()
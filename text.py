@@ -1,6 +1,38 @@
+import argparse
+import bisect
+import csv
+import hashlib
+import json
+import mmap
+import os
 import pickle
+import random
+import struct
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
 from cryptography.fernet import Fernet
 
+# 词库文件格式:
+#   文件头: 魔数 b"UCWB", 版本, 每条记录字节数, 每块记录数, 每块密文字节数, 词条总数
+#   之后是一个个单独加密的记录块。每块明文长度固定，Fernet 密文长度也就固定，
+#   第 i 块的位置可以直接算出来，读取一条词条只需要解密它所在的那一块
+BANK_MAGIC = b"UCWB"
+BANK_VERSION = 1
+BANK_HEADER = struct.Struct(">4sBHHIQ")
+FIELD_SEP = "\x1f"  # 记录内字段分隔符，记录末尾用 \x00 补齐
+
+# 记录字段: 玩家词, 卧底词, 之后是可选的标签
+TAG_FIELDS = ("category", "difficulty", "language")
+
+# 标签倒排索引，保存在词库旁边（WORDS.idx）:
+#   魔数 b"UCWI" + 目录长度 + JSON 目录 {标签: {取值: [起点, 条数]}}，
+#   之后是按词条序号升序排列的 uint32 列表
+INDEX_MAGIC = b"UCWI"
+INDEX_HEADER = struct.Struct(">4sI")
+
 def generate_key():
     """
     生成一个密钥（只需执行一次，然后保存起来）。
@@ -28,17 +60,534 @@ def load_encrypted(filename, key):
     return pickle.loads(data)        # 反序列化回 Python 对象
 
 
+def encode_record(fields, record_size):
+    """
+    把一条词条的各个字段编码为固定长度的记录
+    """
+    data = FIELD_SEP.join(fields).encode()
+    if len(data) > record_size:
+        raise ValueError(f"词条过长: {fields}")
+    return data.ljust(record_size, b"\0")
+
+
+def decode_record(data):
+    return data.rstrip(b"\0").decode().split(FIELD_SEP)
+
+
+class BankWriter:
+    """
+    逐块写入词库：攒满一块就加密写出，内存中最多保留一块明文。
+    append=True 时在已有词库末尾追加，只重新加密最后一个未写满的块
+    """
+
+    def __init__(self, filename, key, record_size=64, block_records=16,
+                 append=False, buffer_size=1 << 20):
+        self.fernet = Fernet(key)
+        self.count = 0
+        self.block = []
+        if append and os.path.exists(filename):
+            self.file = open(filename, "r+b", buffering=buffer_size)
+            self.open_existing()
+        else:
+            self.record_size = record_size
+            self.block_records = block_records
+            # 明文长度固定时密文长度也固定，先加密一块空数据得到密文长度
+            self.token_size = len(self.fernet.encrypt(bytes(record_size * block_records)))
+            self.file = open(filename, "wb", buffering=buffer_size)
+            self.write_header()
+
+    def open_existing(self):
+        header = self.file.read(BANK_HEADER.size)
+        if header[:len(BANK_MAGIC)] != BANK_MAGIC:
+            raise ValueError("旧格式的词库不能追加，请重新生成")
+        (_, version, self.record_size, self.block_records,
+         self.token_size, self.count) = BANK_HEADER.unpack(header)
+        if version != BANK_VERSION:
+            raise ValueError(f"不支持的词库版本: {version}")
+
+        # 最后一块没写满时解密出来继续填充，写回原来的位置
+        full_blocks, partial = divmod(self.count, self.block_records)
+        self.file.seek(BANK_HEADER.size + full_blocks * self.token_size)
+        if partial:
+            block = self.fernet.decrypt(self.file.read(self.token_size))
+            self.block = [
+                block[i * self.record_size:(i + 1) * self.record_size]
+                for i in range(partial)
+            ]
+            self.file.seek(BANK_HEADER.size + full_blocks * self.token_size)
+
+    def write_header(self):
+        self.file.seek(0)
+        self.file.write(BANK_HEADER.pack(
+            BANK_MAGIC, BANK_VERSION, self.record_size,
+            self.block_records, self.token_size, self.count,
+        ))
+
+    def add(self, fields):
+        self.block.append(encode_record(fields, self.record_size))
+        self.count += 1
+        if len(self.block) == self.block_records:
+            self.flush_block()
+
+    def flush_block(self):
+        data = b"".join(self.block).ljust(self.record_size * self.block_records, b"\0")
+        self.file.write(self.fernet.encrypt(data))
+        self.block = []
+
+    def close(self):
+        if self.block:
+            self.flush_block()
+        self.file.truncate()
+        self.write_header()
+        self.file.close()
+
+
+def save_bank(word_pairs, filename, key, **options):
+    """
+    把词条列表写成分块加密的词库
+    """
+    writer = BankWriter(filename, key, **options)
+    for pair in word_pairs:
+        writer.add(pair)
+    writer.close()
+
+
+class WordBank:
+    """
+    按需加载的词库。第一次取词时才读取密钥并用 mmap 打开文件，
+    每次只解密用到的记录块；旧格式（整个文件一次加密）仍然可以读取
+    """
+
+    def __init__(self, filename="data/WORDS", key_file="data/KEY", cache_blocks=64):
+        self.filename = filename
+        self.key_file = key_file
+        self.cache_blocks = cache_blocks
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.pairs = None  # 旧格式的全部词条
+        self.mmap = None
+        self.fernet = None
+        self.count = 0
+        self.blocks = OrderedDict()  # 最近解密的记录块 {块号: 明文}
+
+    def load(self):
+        if self.loaded:
+            return
+        with open(self.key_file, "rb") as f:
+            self.load_key(f.read())
+
+    def load_key(self, key):
+        with self.lock:
+            if self.loaded:
+                return
+            with open(self.filename, "rb") as f:
+                magic = f.read(len(BANK_MAGIC))
+                if magic != BANK_MAGIC:
+                    self.pairs = load_encrypted(self.filename, key)
+                    self.count = len(self.pairs)
+                else:
+                    self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    (_, version, self.record_size, self.block_records,
+                     self.token_size, self.count) = BANK_HEADER.unpack_from(self.mmap)
+                    if version != BANK_VERSION:
+                        raise ValueError(f"不支持的词库版本: {version}")
+                    self.fernet = Fernet(key)
+            self.loaded = True
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.loaded = False
+        self.blocks.clear()
+
+    def __len__(self):
+        self.load()
+        return self.count
+
+    def read_block(self, index):
+        with self.lock:
+            block = self.blocks.get(index)
+            if block is not None:
+                self.blocks.move_to_end(index)
+                return block
+        start = BANK_HEADER.size + index * self.token_size
+        block = self.fernet.decrypt(self.mmap[start:start + self.token_size])
+        with self.lock:
+            self.blocks[index] = block
+            if len(self.blocks) > self.cache_blocks:
+                self.blocks.popitem(last=False)
+        return block
+
+    def record(self, i):
+        """
+        第 i 条词条的全部字段
+        """
+        self.load()
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        if self.pairs is not None:
+            return list(self.pairs[i])
+        block = self.read_block(i // self.block_records)
+        offset = i % self.block_records * self.record_size
+        return decode_record(block[offset:offset + self.record_size])
+
+    def __getitem__(self, i):
+        # [玩家词, 卧底词]
+        return self.record(i)[:2]
+
+    def choice(self, rng=random):
+        count = len(self)
+        if not count:
+            raise IndexError("词库为空")
+        return self[rng.randrange(count)]
+
+
+class IndexBuilder:
+    """
+    生成词库时收集标签倒排表，每个标签每条词条占 4 字节
+    """
+
+    def __init__(self):
+        self.postings = {tag: {} for tag in TAG_FIELDS}
+
+    def add(self, index, fields):
+        for tag, value in zip(TAG_FIELDS, fields[2:]):
+            if value:
+                self.postings[tag].setdefault(value, array("I")).append(index)
+
+    def write(self, filename):
+        directory = {}
+        offset = 0
+        for tag, values in self.postings.items():
+            directory[tag] = {}
+            for value, items in sorted(values.items()):
+                directory[tag][value] = [offset, len(items)]
+                offset += len(items)
+        header = json.dumps(directory, ensure_ascii=False).encode()
+        # 倒排表按 4 字节对齐，读取时可以直接 cast 成 uint32
+        header += b" " * (-(INDEX_HEADER.size + len(header)) % 4)
+        with open(filename, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(header)))
+            f.write(header)
+            for values in self.postings.values():
+                for _, items in sorted(values.items()):
+                    items.tofile(f)
+
+
+class WordIndex:
+    """
+    按标签筛选词条。倒排表用 mmap 读取，筛选结果（交集）缓存起来，
+    同一个筛选条件之后每次开局都是 O(1)
+    """
+
+    def __init__(self, filename="data/WORDS.idx", cache_size=64):
+        self.filename = filename
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.directory = {}
+        self.postings = None
+        self.cache = OrderedDict()  # {筛选条件: 词条序号列表}
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not os.path.exists(self.filename):
+                # 没有索引时不能按标签筛选
+                return
+            with open(self.filename, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = INDEX_HEADER.unpack_from(data)
+            if magic != INDEX_MAGIC:
+                raise ValueError("词库索引格式错误")
+            start = INDEX_HEADER.size + length
+            self.directory = json.loads(bytes(data[INDEX_HEADER.size:start]))
+            self.postings = memoryview(data)[start:].cast("I")
+
+    def tags(self):
+        """
+        每种标签的所有取值
+        """
+        self.load()
+        return {tag: list(values) for tag, values in self.directory.items()}
+
+    def posting(self, tag, value):
+        entry = self.directory.get(tag, {}).get(value)
+        if entry is None:
+            return array("I")
+        offset, count = entry
+        return self.postings[offset:offset + count]
+
+    def select(self, word_filter):
+        """
+        符合所有条件的词条序号（升序）
+        """
+        self.load()
+        key = tuple(sorted(word_filter.items()))
+        with self.lock:
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                return result
+
+        lists = sorted(
+            (self.posting(tag, value) for tag, value in key), key=len
+        )
+        if not lists:
+            return None
+        # 遍历最短的列表，在其余列表里二分查找
+        result = array("I")
+        for index in lists[0]:
+            for other in lists[1:]:
+                i = bisect.bisect_left(other, index)
+                if i == len(other) or other[i] != index:
+                    break
+            else:
+                result.append(index)
+
+        with self.lock:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+
+class Deck:
+    """
+    不重复地发词条：用随机密钥的 Feistel 网络把 0..size-1 打乱成一个排列，
+    只保存密钥和当前位置，发一张牌是 O(1)，和词库大小无关。
+    一轮发完之后换一组密钥重新洗牌
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, size, rng=random):
+        self.size = size
+        self.rng = rng
+        # 置换的定义域是 2 的偶数次方，且不小于 size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.shuffle()
+
+    def shuffle(self):
+        self.keys = [self.rng.getrandbits(64) for _ in range(self.ROUNDS)]
+        self.position = 0
+
+    def round(self, value, key):
+        x = ((value ^ key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return (x ^ (x >> 29)) & self.mask
+
+    def permute(self, index):
+        # 超出范围的结果继续置换（cycle walking），平均不到 4 次就落回范围内
+        while True:
+            left, right = index >> self.half_bits, index & self.mask
+            for key in self.keys:
+                left, right = right, left ^ self.round(right, key)
+            index = (left << self.half_bits) | right
+            if index < self.size:
+                return index
+
+    def deal(self):
+        if not self.size:
+            raise IndexError("词库为空")
+        if self.position >= self.size:
+            self.shuffle()
+        index = self.permute(self.position)
+        self.position += 1
+        return index
+
+    def remaining(self):
+        return self.size - self.position
+
+
+class DigestSet:
+    """
+    只保存 64 位摘要的去重集合（开放寻址），每个词条约占 16 字节，
+    不保存词条文本，千万级词条也能放进内存
+    """
+
+    def __init__(self, capacity=1 << 16):
+        self.slots = array("Q", bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.size = 0
+
+    def add(self, digest):
+        """
+        加入摘要，已经存在时返回 False
+        """
+        digest = digest or 1  # 0 表示空槽
+        i = digest & self.mask
+        while True:
+            slot = self.slots[i]
+            if slot == 0:
+                break
+            if slot == digest:
+                return False
+            i = (i + 1) & self.mask
+        self.slots[i] = digest
+        self.size += 1
+        if self.size * 2 > len(self.slots):
+            self.grow()
+        return True
+
+    def grow(self):
+        old = self.slots
+        self.slots = array("Q", bytes(16 * len(old)))
+        self.mask = len(self.slots) - 1
+        self.size = 0
+        for digest in old:
+            if digest:
+                self.add(digest)
+
+
+def pair_digest(fields):
+    # 只按两个词去重，不区分先后顺序
+    key = FIELD_SEP.join(sorted(fields[:2])).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+def normalize_fields(fields):
+    """
+    统一全角半角、去掉首尾空白；不是有效词条时返回 None
+    """
+    fields = [
+        unicodedata.normalize("NFKC", "" if field is None else str(field)).strip()
+        for field in fields[:2 + len(TAG_FIELDS)]
+    ]
+    if len(fields) < 2 or not fields[0] or not fields[1] or fields[0] == fields[1]:
+        return None
+    # 标签不区分大小写
+    fields[2:] = [tag.casefold() for tag in fields[2:]]
+    while len(fields) > 2 and not fields[-1]:
+        fields.pop()
+    if any(FIELD_SEP in field or "\0" in field for field in fields):
+        return None
+    return fields
+
+
+def read_source(path, fmt=None):
+    """
+    逐行读取 CSV/TSV/JSONL 文件，产出每行的字段列表
+    """
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if fmt == "jsonl":
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    yield None
+                    continue
+                if isinstance(row, dict):
+                    row = [row.get("word"), row.get("undercover")] + [
+                        row.get(tag) for tag in TAG_FIELDS
+                    ]
+                yield row if isinstance(row, list) else None
+        elif fmt in ("csv", "tsv"):
+            yield from csv.reader(f, delimiter="\t" if fmt == "tsv" else ",")
+        else:
+            raise ValueError(f"不支持的文件格式: {path}")
+
+
+def build_bank(sources, filename, key, append=False, fmt=None, **options):
+    """
+    流式生成词库：逐行读取、规范化、去重后分块加密写出，返回统计信息
+    """
+    stats = {"rows": 0, "written": 0, "duplicates": 0, "invalid": 0, "bytes": 0}
+    seen = DigestSet()
+    postings = IndexBuilder()
+    start = time.perf_counter()
+
+    writer = BankWriter(filename, key, append=append, **options)
+    try:
+        if writer.count:
+            # 追加时先登记已有词条的摘要和标签，避免重复
+            existing = WordBank(filename)
+            existing.load_key(key)
+            for i in range(writer.count):
+                fields = existing.record(i)
+                seen.add(pair_digest(fields))
+                postings.add(i, fields)
+            existing.close()
+
+        for path in sources:
+            stats["bytes"] += os.path.getsize(path)
+            for row in read_source(path, fmt):
+                stats["rows"] += 1
+                fields = normalize_fields(row) if row else None
+                if fields is None:
+                    stats["invalid"] += 1
+                elif not seen.add(pair_digest(fields)):
+                    stats["duplicates"] += 1
+                else:
+                    try:
+                        writer.add(fields)
+                    except ValueError:
+                        stats["invalid"] += 1
+                        continue
+                    postings.add(writer.count - 1, fields)
+                    stats["written"] += 1
+    finally:
+        writer.close()
+    postings.write(filename + ".idx")
+
+    stats["total"] = writer.count
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def print_stats(stats):
+    seconds = max(stats["seconds"], 1e-9)
+    print(f"读取 {stats['rows']} 行，写入 {stats['written']} 条，"
+          f"重复 {stats['duplicates']} 条，无效 {stats['invalid']} 条，"
+          f"词库共 {stats['total']} 条")
+    print(f"耗时 {seconds:.2f} 秒，{stats['rows'] / seconds:.0f} 行/秒，"
+          f"{stats['bytes'] / seconds / 1e6:.1f} MB/秒")
+
+
 if __name__ == '__main__':
-    # 词条数据[玩家, 卧底]
+    # 词条数据[玩家, 卧底]，没有指定源文件时使用
     word_pairs = [
     ]
-    key = generate_key()
-    with open("data/KEY", "wb") as f:
-        f.write(key)
 
-    save_encrypted(word_pairs, "data/WORDS", key)
-    with open("data/KEY", "rb") as f:
-        key = f.read()
+    parser = argparse.ArgumentParser(description="生成加密词库")
+    parser.add_argument("sources", nargs="*", help="CSV/TSV/JSONL 源文件，每行: 玩家词, 卧底词")
+    parser.add_argument("-o", "--output", default="data/WORDS", help="词库文件")
+    parser.add_argument("-k", "--key", default="data/KEY", help="密钥文件，不存在时自动生成")
+    parser.add_argument("-a", "--append", action="store_true", help="追加到已有词库")
+    parser.add_argument("--format", choices=["csv", "tsv", "jsonl"], help="源文件格式，默认按扩展名判断")
+    parser.add_argument("--record-size", type=int, default=64, help="每条记录的字节数")
+    parser.add_argument("--block-records", type=int, default=16, help="每个加密块的记录数")
+    args = parser.parse_args()
+
+    if args.append and not args.sources:
+        parser.error("追加时需要指定源文件")
+    if os.path.exists(args.key):
+        with open(args.key, "rb") as f:
+            key = f.read()
+    elif args.append:
+        parser.error("追加时需要原来的密钥")
+    else:
+        key = generate_key()
+        with open(args.key, "wb") as f:
+            f.write(key)
+
+    options = {"record_size": args.record_size, "block_records": args.block_records}
+    if args.sources:
+        print_stats(build_bank(args.sources, args.output, key, args.append, args.format, **options))
+    else:
+        writer = BankWriter(args.output, key, append=args.append, **options)
+        postings = IndexBuilder()
+        for pair in word_pairs:
+            writer.add(pair)
+            postings.add(writer.count - 1, pair)
+        writer.close()
+        postings.write(args.output + ".idx")
 
-    loaded_pairs = load_encrypted("data/WORDS", key)
-    print(loaded_pairs)
+    bank = WordBank(args.output, args.key)
+    print(f"{args.output}: {len(bank)} 条词条")